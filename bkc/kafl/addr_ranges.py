@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2022 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Map arbitrary code addresses, e.g. RIPs from crash logs, to the enclosing
+# function and source line range
+#
+# Uses the function symbols in System.map and the entries of addr2line.lst,
+# both kept as sorted address arrays and looked up with searchsorted().
+#
+
+import os
+import re
+import sys
+import argparse
+
+import numpy as np
+
+# System.map symbol types that mark code
+TEXT_SYMBOL_TYPES = 'tTwW'
+
+
+class SymbolMap:
+    """
+    Function start addresses from System.map. A function is assumed to end
+    at the next symbol in the text section.
+    """
+
+    def __init__(self, map_file):
+        starts = list()
+        names = list()
+        with open(map_file, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3 or fields[1] not in TEXT_SYMBOL_TYPES:
+                    continue
+                starts.append(int(fields[0], 16))
+                names.append(fields[2])
+        order = np.argsort(np.array(starts, dtype=np.uint64), kind='stable')
+        self.starts = np.array(starts, dtype=np.uint64)[order]
+        self.names = [names[i] for i in order.tolist()]
+
+    def lookup(self, ip):
+        """
+        Return (name, start, end) of the function containing ip, or None
+        """
+        if not 0 <= ip < 1 << 64:
+            return None
+        j = int(np.searchsorted(self.starts, np.uint64(ip), side='right'))
+        if j == 0 or j == len(self.starts):
+            return None
+        return self.names[j-1], int(self.starts[j-1]), int(self.starts[j])
+
+
+class AddressRangeIndex:
+    """
+    Look up the function and file:line of any address inside a known code
+    range, not only at the block addresses listed in addr2line.lst.
+
+    lines is an Addr2LineIndex, holding entries sorted by address. An address
+    is attributed to the closest entry at or below it, if both belong to the
+    same function: same System.map symbol if available, otherwise the same
+    outermost function as the next entry above it. Otherwise only the
+    System.map function is reported.
+    """
+
+    def __init__(self, lines, symbols=None):
+        self.lines = lines
+        self.symbols = symbols
+
+    def outer_entry(self, j):
+        # last, outermost inlined entry of the address at position j
+        addrs = self.lines.addrs
+        return int(np.searchsorted(addrs, addrs[j], side='right')) - 1
+
+    def lookup(self, ip):
+        """
+        Return (func, lino, start, end) of the code range containing ip, or
+        None. lino is None if only the function is known.
+        """
+        if not 0 <= ip < 1 << 64:
+            return None
+        symbol = self.symbols.lookup(ip) if self.symbols else None
+        lines = self.lines
+        addrs = lines.addrs
+
+        j = int(np.searchsorted(addrs, np.uint64(ip), side='right'))
+        if j > 0:
+            i = j - 1
+            start = int(addrs[i])
+            end = int(addrs[j]) if j < len(addrs) else None
+            func = lines.funcs[lines.func_ids[i]]
+            if symbol:
+                inside = start >= symbol[1]
+                end = symbol[2] if end is None else min(end, symbol[2])
+            else:
+                inside = start == ip or (
+                    end is not None and lines.funcs[lines.func_ids[self.outer_entry(j)]] == func)
+            if inside:
+                return func, lines.linos[lines.lino_ids[i]], start, end
+
+        if symbol:
+            return symbol[0], None, symbol[1], symbol[2]
+        return None
+
+
+def read_ips(stream):
+    """
+    Extract all kernel code addresses from a text, e.g. a crash log
+    """
+    for line in stream:
+        for m in re.finditer(r"\b(?:0x)?(ffffffff[0-9a-f]{8})\b", line):
+            yield int(m.group(1), 16)
+
+
+def main():
+    from smatch_match import Addr2LineIndex
+
+    parser = argparse.ArgumentParser(description='Look up code addresses in a kAFL workdir.')
+    parser.add_argument('work_dir', metavar='<work_dir>', type=str,
+                        help='workdir with traces/addr2line.lst and target/System.map')
+    parser.add_argument('ips', metavar='<ip>', type=str, nargs='*',
+                        help='addresses to look up (default: scan stdin for addresses)')
+
+    args = parser.parse_args()
+
+    addr2line = os.path.join(args.work_dir, "traces/addr2line.lst")
+    system_map = os.path.join(args.work_dir, "target/System.map")
+
+    if not os.path.exists(addr2line):
+        sys.exit("Error: Could not find %s." % addr2line)
+    symbols = SymbolMap(system_map) if os.path.exists(system_map) else None
+    index = AddressRangeIndex(Addr2LineIndex(addr2line).open(), symbols)
+
+    if args.ips:
+        ips = [int(ip, 16) for ip in args.ips]
+    else:
+        ips = read_ips(sys.stdin)
+
+    for ip in ips:
+        found = index.lookup(ip)
+        if not found:
+            print("0x%016x: ??" % ip)
+            continue
+        func, lino, start, end = found
+        print("0x%016x: %s at %s (0x%x-%s)" %
+              (ip, func, lino or '??', start, "0x%x" % end if end is not None else '?'))
+
+
+if __name__ == "__main__":
+    main()
@@ -61,6 +61,7 @@ Available commands <cmd>:
   smatch <workdir>        - get addr2line and smatch_match results from traces
 
   build <dir> <build>     - use harness config at <dir> to build kernel at <build>
+  config <dir> <build>    - only generate the final kernel .config and build_params.txt at <build>
   audit <dir> <config>    - smatch-audit guest-kernel using <config> and store to <dir>
 
 <target> is a folder with vmlinux, System.map and bzImage
@@ -321,6 +322,53 @@ function smatch_audit()
 	$BKC_ROOT/bkc/audit/smatch_audit.sh $TARGET_DIR $TARGET_CONFIG
 }
 
+# pipeline.py runs config and build jobs in parallel. Serialize the steps that
+# run make in the shared $LINUX_GUEST tree itself (mrproper, and the clean tree
+# check of O= builds), the O= build itself only writes to <build>
+function lock_linux_guest()
+{
+	exec 9> "${TMPDIR:-/tmp}/fuzz_sh_$(realpath -- "$LINUX_GUEST" | sha256sum | cut -c 1-16).lock"
+	flock 9
+}
+
+function unlock_linux_guest()
+{
+	exec 9>&-
+}
+
+# generate the final kernel config + build parameters at <build>, without building
+function config_harness()
+{
+	test $# -eq 2 || usage "Wrong number of arguments"
+	TEMPLATE_DIR="$(realpath -e -- "$1")"; shift
+	BUILD_DIR="$(realpath -e -- "$1")"; shift
+
+	test -f "$TEMPLATE_DIR/linux.template" || fatal "Could not find kernel template config in $TEMPLATE_DIR"
+	test -f "$TEMPLATE_DIR/linux.config" || fatal "Could not find kernel harnes config in $TEMPLATE_DIR"
+
+	test -d "$LINUX_GUEST" || fatal "Could not find kernel source tree at \$LINUX_GUEST"
+	test -f "$LINUX_GUEST/Kconfig" || fatal "\$LINUX_GUEST is not pointing to a Linux source tree?"
+
+	cd $TEMPLATE_DIR
+	cat linux.template linux.config > $BUILD_DIR/.config
+	cd $LINUX_GUEST
+	lock_linux_guest
+	make O=$BUILD_DIR olddefconfig
+	unlock_linux_guest
+
+	# anything else that goes into the kernel build
+	echo "KERNEL_BUILD_PARAMS=$KERNEL_BUILD_PARAMS" > $BUILD_DIR/build_params.txt
+	if git -C $LINUX_GUEST rev-parse HEAD > /dev/null 2>&1; then
+		echo "LINUX_GUEST_REV=$(git -C $LINUX_GUEST rev-parse HEAD)" >> $BUILD_DIR/build_params.txt
+		echo "LINUX_GUEST_DIFF=$(git -C $LINUX_GUEST diff HEAD | sha256sum | cut -d ' ' -f 1)" >> $BUILD_DIR/build_params.txt
+		# git diff ignores untracked files - hash their names and contents too
+		echo "LINUX_GUEST_UNTRACKED=$(git -C $LINUX_GUEST ls-files -o --exclude-standard -z |
+			(cd $LINUX_GUEST && xargs -0 -r sha256sum --) | sha256sum | cut -d ' ' -f 1)" >> $BUILD_DIR/build_params.txt
+	else
+		echo "LINUX_GUEST_REV=$(realpath $LINUX_GUEST)" >> $BUILD_DIR/build_params.txt
+	fi
+}
+
 # build target from generated template config
 function build_harness()
 {
@@ -340,8 +388,10 @@ function build_harness()
 	test -d $BUILD_DIR || mkdir $BUILD_DIR
 	cat linux.template linux.config > $BUILD_DIR/.config
 	cd $LINUX_GUEST
+	lock_linux_guest
 	make mrproper
 	make O=$BUILD_DIR olddefconfig
+	unlock_linux_guest
 	make O=$BUILD_DIR "$KERNEL_BUILD_PARAMS"
 }
 
@@ -355,11 +405,16 @@ function smatch_match()
 		# match smatch report against line coverage reported in addr2line.lst
 		SMATCH_OUTPUT=$WORK_DIR/traces/smatch_match.lst
 
-		$BKC_ROOT/bkc/kafl/gen_addr2line.sh $WORK_DIR
-		# Make paths relative
-		$BKC_ROOT/bkc/coverage/strip_addr2line_absolute_path.sh $WORK_DIR/target/vmlinux $WORK_DIR/traces/addr2line.lst
+		if test "0$USE_NATIVE_SYMBOLIZER" -gt 0 -a "0$USE_GHIDRA" -eq 0; then
+			# symbolize edges_uniq.lst in-process, writes addr2line.lst with relative paths
+			$BKC_ROOT/bkc/kafl/smatch_match.py --symbolize $WORK_DIR |sort -u > $SMATCH_OUTPUT
+		else
+			$BKC_ROOT/bkc/kafl/gen_addr2line.sh $WORK_DIR
+			# Make paths relative
+			$BKC_ROOT/bkc/coverage/strip_addr2line_absolute_path.sh $WORK_DIR/target/vmlinux $WORK_DIR/traces/addr2line.lst
 
-		$BKC_ROOT/bkc/kafl/smatch_match.py $WORK_DIR |sort -u > $SMATCH_OUTPUT
+			$BKC_ROOT/bkc/kafl/smatch_match.py $WORK_DIR |sort -u > $SMATCH_OUTPUT
+		fi
 		echo "Discovered smatch matches: $(wc -l $SMATCH_OUTPUT)"
 	fi
 
@@ -397,6 +452,9 @@ case $ACTION in
 	"build")
 		build_harness "$@"
 		;;
+	"config")
+		config_harness "$@"
+		;;
 	"full")
 		KAFL_OPTS=$KAFL_FULL_OPTS
 		run "$@"
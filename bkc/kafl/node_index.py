@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2022 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Persistent index of the node metadata in a kAFL workdir
+#
+# kAFL keeps one msgpack file per corpus entry in <workdir>/metadata/. The
+# fields needed by stats.py and smatch_match.py are copied into an SQLite
+# table at <workdir>/nodes.db, and only files with a new mtime or size are
+# decoded again on the next update(). update(quick=True) only reads nodes
+# after the highest indexed id, for polling a workdir that is still fuzzed.
+#
+
+import os
+import sys
+import sqlite3
+import msgpack
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# node metadata files read per thread pool task
+META_BATCH_SIZE = 256
+
+NODE_COLUMNS = ('id', 'exit_reason', 'time', 'state', 'fav_bits', 'payload')
+
+
+def read_node_meta(meta_file):
+    """
+    Decode only the indexed fields of a kAFL node metadata file, skipping
+    over the bitmaps and other fields. Returns (id, exit_reason, time,
+    state, number of fav_bits).
+    """
+    nid = exit_reason = seconds = state = None
+    fav_bits = 0
+    unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+    with open(meta_file, 'rb') as f:
+        unpacker.feed(f.read())
+    for _ in range(unpacker.read_map_header()):
+        key = unpacker.unpack()
+        if key == 'id':
+            nid = unpacker.unpack()
+        elif key == 'info':
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key == 'time':
+                    seconds = unpacker.unpack()
+                elif key == 'exit_reason':
+                    exit_reason = unpacker.unpack()
+                else:
+                    unpacker.skip()
+        elif key == 'state':
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key == 'name':
+                    state = unpacker.unpack()
+                else:
+                    unpacker.skip()
+        elif key == 'fav_bits':
+            fav_bits = unpacker.read_map_header()
+            for _ in range(2 * fav_bits):
+                unpacker.skip()
+        else:
+            unpacker.skip()
+    return nid, exit_reason, seconds, state, fav_bits
+
+
+class NodeIndex:
+    """
+    Node metadata of one kAFL workdir, kept in <work_dir>/nodes.db
+
+    Falls back to an in-memory database if the workdir is not writable.
+    """
+
+    def __init__(self, work_dir, db_file=None):
+        self.work_dir = work_dir
+        self.meta_dir = os.path.join(work_dir, "metadata")
+        self.db_file = db_file or os.path.join(work_dir, "nodes.db")
+        self.meta_mtime_ns = None
+        self.max_id = None
+        self.corpus_dirs = None
+        self.changed = list()
+        self.removed = list()
+        try:
+            self.db = sqlite3.connect(self.db_file, timeout=600)
+            self.create_tables()
+        except sqlite3.OperationalError as e:
+            print("Could not open %s (%s), not keeping the node index." % (self.db_file, e),
+                  file=sys.stderr)
+            self.db_file = ":memory:"
+            self.db = sqlite3.connect(self.db_file)
+            self.create_tables()
+
+    def create_tables(self):
+        self.db.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                        "id INTEGER PRIMARY KEY, exit_reason TEXT, time REAL, state TEXT, "
+                        "fav_bits INTEGER, payload TEXT, "
+                        "file TEXT UNIQUE NOT NULL, mtime_ns INTEGER, size INTEGER)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def scan_files(self):
+        """
+        Return {file name: (mtime_ns, size)} for all node metadata files
+        """
+        files = dict()
+        with os.scandir(self.meta_dir) as it:
+            for entry in it:
+                if entry.name.startswith("node_"):
+                    st = entry.stat()
+                    files[entry.name] = (st.st_mtime_ns, st.st_size)
+        return files
+
+    def scan_payloads(self):
+        """
+        Return {node file name: payload path relative to the workdir}
+        """
+        payloads = dict()
+        corpus_dir = os.path.join(self.work_dir, "corpus")
+        if not os.path.isdir(corpus_dir):
+            return payloads
+        for exit_reason in sorted(os.listdir(corpus_dir)):
+            input_dir = os.path.join(corpus_dir, exit_reason)
+            if not os.path.isdir(input_dir):
+                continue
+            for name in os.listdir(input_dir):
+                if name.startswith("payload_"):
+                    node_name = name.replace("payload_", "node_")
+                    payloads[node_name] = "corpus/%s/%s" % (exit_reason, name)
+        return payloads
+
+    def find_payload(self, node_name, exit_reason):
+        """
+        Return the payload path of a single node, looking into the corpus dir
+        of its exit reason first
+        """
+        if self.corpus_dirs is None:
+            corpus_dir = os.path.join(self.work_dir, "corpus")
+            self.corpus_dirs = sorted(os.listdir(corpus_dir)) if os.path.isdir(corpus_dir) else []
+        name = node_name.replace("node_", "payload_")
+        for exit_reason in [exit_reason] + self.corpus_dirs:
+            payload = "corpus/%s/%s" % (exit_reason, name)
+            if os.path.exists(os.path.join(self.work_dir, payload)):
+                return payload
+        return None
+
+    def read_batch(self, batch):
+        rows = list()
+        for name, mtime_ns, size in batch:
+            try:
+                meta = read_node_meta(os.path.join(self.meta_dir, name))
+            except (OSError, ValueError, msgpack.UnpackException):
+                # removed or still being written by kAFL, retry next time
+                continue
+            rows.append(meta + (name, mtime_ns, size))
+        return rows
+
+    def update(self, threads=None, quick=False):
+        """
+        Bring the index up to date with metadata/, decoding only new or
+        modified node files. Returns the number of updated nodes, which are
+        also kept in self.changed (as dicts) and self.removed (ids).
+
+        With quick=True, only the nodes after the highest indexed id are read,
+        see update_new(). Rewritten nodes are not picked up. A full update is
+        done instead on the first call, and when the mtime of metadata/ went
+        backwards, e.g. because the workdir was replaced.
+        """
+        self.changed = list()
+        self.removed = list()
+        meta_mtime_ns = os.stat(self.meta_dir).st_mtime_ns
+        if quick and self.meta_mtime_ns is not None and meta_mtime_ns >= self.meta_mtime_ns:
+            return self.update_new()
+        self.meta_mtime_ns = meta_mtime_ns
+        self.max_id = None
+        self.corpus_dirs = None
+
+        files = self.scan_files()
+        known = dict()
+        known_ids = dict()
+        known_payloads = dict()
+        for name, mtime_ns, size, nid, payload in self.db.execute(
+                "SELECT file, mtime_ns, size, id, payload FROM nodes"):
+            known[name] = (mtime_ns, size)
+            known_ids[name] = nid
+            known_payloads[name] = payload
+
+        removed = [(name,) for name in known if name not in files]
+        changed = sorted((name, mtime_ns, size) for name, (mtime_ns, size) in files.items()
+                         if known.get(name) != (mtime_ns, size))
+
+        batches = [changed[i:i+META_BATCH_SIZE]
+                   for i in range(0, len(changed), META_BATCH_SIZE)]
+        rows = list()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for batch_rows in pool.map(self.read_batch, batches):
+                rows.extend(batch_rows)
+
+        # payloads are matched by name, kAFL may move them between corpus dirs
+        payloads = self.scan_payloads()
+        rows = [row[:5] + (payloads.get(row[5]),) + row[5:] for row in rows]
+        moved = [(payloads.get(name), name) for name, payload in known_payloads.items()
+                 if name in files and payloads.get(name) != payload]
+
+        self.changed = [dict(zip(NODE_COLUMNS, row[:6])) for row in rows]
+        self.removed = [known_ids[name] for name, in removed]
+
+        with self.db:
+            self.db.executemany("DELETE FROM nodes WHERE file = ?", removed)
+            self.db.executemany("UPDATE nodes SET payload = ? WHERE file = ?", moved)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO nodes (id, exit_reason, time, state, fav_bits, "
+                "payload, file, mtime_ns, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def update_new(self):
+        """
+        Index only the node files after the highest indexed id. kAFL numbers
+        nodes sequentially, so files are probed by name up to the first one
+        that does not exist (yet). The cost does not depend on the corpus
+        size, and nothing is read if the mtime of metadata/ did not change:
+        kAFL writes node files by renaming a temporary file.
+        """
+        meta_mtime_ns = os.stat(self.meta_dir).st_mtime_ns
+        if meta_mtime_ns == self.meta_mtime_ns:
+            return 0
+        if self.max_id is None:
+            max_id = self.db.execute("SELECT MAX(id) FROM nodes").fetchone()[0]
+            self.max_id = -1 if max_id is None else max_id
+
+        rows = list()
+        complete = True
+        while True:
+            name = "node_%05d" % (self.max_id + 1)
+            try:
+                st = os.stat(os.path.join(self.meta_dir, name))
+            except FileNotFoundError:
+                break
+            row = self.read_batch([(name, st.st_mtime_ns, st.st_size)])
+            if not row:
+                # not readable yet, retry on the next update
+                complete = False
+                break
+            row = row[0]
+            rows.append(row[:5] + (self.find_payload(name, row[1]),) + row[5:])
+            self.max_id += 1
+        if complete:
+            self.meta_mtime_ns = meta_mtime_ns
+
+        self.changed = [dict(zip(NODE_COLUMNS, row[:6])) for row in rows]
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO nodes (id, exit_reason, time, state, fav_bits, "
+                "payload, file, mtime_ns, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def nodes(self, exit_reasons=None):
+        """
+        Return all indexed nodes as dicts of NODE_COLUMNS, ordered by id
+        """
+        query = "SELECT %s FROM nodes" % ", ".join(NODE_COLUMNS)
+        params = list()
+        if exit_reasons is not None:
+            params = list(exit_reasons)
+            query += " WHERE exit_reason IN (%s)" % ",".join("?" * len(params))
+        query += " ORDER BY id"
+        return [dict(zip(NODE_COLUMNS, row)) for row in self.db.execute(query, params)]
+
+
+def open_node_index(work_dir, threads=None):
+    """
+    Return the NodeIndex of work_dir, updated to the current metadata/
+    """
+    index = NodeIndex(work_dir)
+    index.update(threads=threads)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or update the node index of a kAFL workdir.')
+    parser.add_argument('work_dir', metavar='<work_dir>', type=str,
+                        help='kAFL workdir with metadata/')
+    parser.add_argument('-p', metavar='<n>', type=int, default=None,
+                        help='number of threads for reading metadata')
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.work_dir, "metadata")):
+        sys.exit("Error: Could not find %s/metadata." % args.work_dir)
+
+    index = NodeIndex(args.work_dir)
+    updated = index.update(threads=args.p)
+    total = index.db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+    print("Updated %d of %d nodes in %s" % (updated, total, index.db_file))
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
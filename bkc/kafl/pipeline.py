@@ -17,16 +17,24 @@
 #   - Provide multiple target folders and/or constrain selection with --harness <pattern>
 #     --rebuild forces a kernel rebuild even if target/ components already exist for the harness
 #
-# - Currently not clever enough to properly delete partial result on failure/abort,
-#   which also means we cannot reasonably scan + resume an aborted run
+# - Task states are recorded in <campaign>/pipeline_journal.jsonl. Rerun on the same
+#   campaign root to resume an aborted run: completed builds, fuzz, trace and smatch
+#   jobs are skipped, interrupted or failed ones are started again. The workdir of a
+#   partial fuzz job is kept at <workdir>.partial-<timestamp>, unless --clean-partial
+#   is given. Other partial results are deleted
 #
 # - But you can always inspect the target folders and run the subtask manually there: most pipeline tasks
 #   are simply executing `fuzz.sh` from the harness folder and pickup the relevant configs/files from there
 
 import os
 import sys
+import json
 
+import fcntl
+import shutil
+import hashlib
 import tempfile
+import threading
 import argparse
 import time
 import subprocess
@@ -34,6 +42,7 @@ import subprocess
 
 from pathlib import Path
 from pprint import pformat
+from concurrent.futures import wait, FIRST_COMPLETED
 
 import parsl
 from parsl.app.app import python_app
@@ -65,63 +74,427 @@ def all_exist(touchfiles):
             return False
     return True
 
+
+def build_cache_key(build_dir):
+    """
+    Hash of the final kernel config and build parameters at build_dir,
+    as generated by `fuzz.sh config`
+    """
+    h = hashlib.sha256()
+    for name in ['.config', 'build_params.txt']:
+        with open(build_dir/name, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def build_cache_valid(args, cache_dir):
+    marker = cache_dir/'complete'
+    if not marker.exists():
+        return False
+    # on --rebuild, only reuse builds done by this run
+    return not args.rebuild or marker.stat().st_mtime >= args.start_time
+
+
+def link_files(files, target_dir):
+    """
+    Hardlink files into target_dir, or copy them if that is not possible
+    """
+    for f in files:
+        dst = target_dir/f.name
+        if dst.exists():
+            dst.unlink()
+        try:
+            os.link(f, dst)
+        except OSError:
+            shutil.copy(f, dst)
+
+
+def lock_file(path):
+    """
+    Return the open lock file at path if we got an exclusive flock() on it,
+    otherwise None
+    """
+    f = open(path, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def dir_size_mb(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return size >> 20
+
+
+def read_config(config_file):
+    try:
+        with open(config_file, 'r') as f:
+            return set(line for line in f if line.startswith('CONFIG_'))
+    except OSError:
+        return None
+
+
+class BuildPool:
+    """
+    Warm kernel build trees at <pool_dir>/slot_N for incremental rebuilds
+
+    Harness configs mostly differ in a few options, so a build is done in
+    the free slot with the closest .config and make only rebuilds what is
+    affected. Slots are locked with flock() while in use, and the least
+    recently used ones are removed when the pool exceeds its disk budget.
+    The most recently used slot is always kept, even if it alone exceeds
+    the budget. Slot sizes are measured once, after the first build in the
+    slot, and kept in <slot>/size_mb.
+    """
+
+    def __init__(self, pool_dir, budget_mb):
+        self.pool_dir = pool_dir
+        self.budget_mb = budget_mb
+        self.lock = threading.Lock()
+
+    def slots(self):
+        return [d for d in self.pool_dir.glob('slot_*') if d.is_dir()]
+
+    def acquire(self, config_file):
+        """
+        Lock the free slot with the .config closest to config_file, or a new
+        slot. Returns (slot_dir, lock), or None if config_file cannot be read
+        and the pool should not be used.
+        """
+        config = read_config(config_file)
+        if config is None:
+            return None
+        best = None
+        with self.lock:
+            os.makedirs(self.pool_dir, exist_ok=True)
+            for slot in self.slots():
+                lock = lock_file(f"{slot}.lock")
+                if not lock:
+                    continue
+                slot_config = read_config(slot/'.config')
+                distance = len(config ^ slot_config) if slot_config else len(config)
+                if best and best[0] <= distance:
+                    lock.close()
+                    continue
+                if best:
+                    best[2].close()
+                best = (distance, slot, lock)
+            if best:
+                return best[1], best[2]
+
+            n = 0
+            while True:
+                slot = self.pool_dir/f"slot_{n}"
+                if not slot.exists():
+                    lock = lock_file(f"{slot}.lock")
+                    if lock:
+                        os.makedirs(slot, exist_ok=True)
+                        return slot, lock
+                n += 1
+
+    def release(self, slot, lock):
+        (slot/'last_used').touch()
+        size_file = slot/'size_mb'
+        if not size_file.exists():
+            size_file.write_text(str(dir_size_mb(slot)))
+        lock.close()
+        self.trim()
+
+    @staticmethod
+    def slot_size(slot):
+        try:
+            return int((slot/'size_mb').read_text())
+        except (OSError, ValueError):
+            return dir_size_mb(slot)
+
+    def trim(self):
+        """
+        Remove least recently used slots until the pool fits its budget
+        """
+        with self.lock:
+            slots = list()
+            for slot in self.slots():
+                last_used = slot/'last_used'
+                mtime = last_used.stat().st_mtime if last_used.exists() else 0
+                slots.append((mtime, slot, self.slot_size(slot)))
+            total = sum(size for _, _, size in slots)
+            # keep the most recently used slot, so that there is a warm tree
+            for _, slot, size in sorted(slots)[:-1]:
+                if total <= self.budget_mb:
+                    break
+                lock = lock_file(f"{slot}.lock")
+                if not lock:
+                    continue
+                print(f"Removing build pool {slot.name} ({size} MiB)")
+                shutil.rmtree(slot, ignore_errors=True)
+                lock.close()
+                total -= size
+
+
+def glob_state(pattern):
+    """
+    Return [number of files, newest mtime_ns] for a glob pattern
+    """
+    mtimes = [f.stat().st_mtime_ns for f in pattern.parent.glob(pattern.name)]
+    return [len(mtimes), max(mtimes, default=0)]
+
+
+def output_states(root, files=(), patterns=()):
+    """
+    Return {path relative to root: [size, mtime_ns]} for the given output
+    files of a task, and {pattern relative to root: glob_state()} for
+    outputs made of many files
+    """
+    outputs = dict()
+    for path in files:
+        st = os.stat(path)
+        outputs[str(Path(path).relative_to(root))] = [st.st_size, st.st_mtime_ns]
+    for pattern in patterns:
+        outputs[str(Path(pattern).relative_to(root))] = glob_state(Path(pattern))
+    return outputs
+
+
+def outputs_unchanged(root, outputs):
+    # outputs are rewritten, never modified in place: size and mtime will do
+    for name, state in outputs.items():
+        if '*' in name:
+            if glob_state(root/name) != state[:2]:
+                return False
+            continue
+        try:
+            st = os.stat(root/name)
+        except OSError:
+            return False
+        if [st.st_size, st.st_mtime_ns] != state[:2]:
+            return False
+    return True
+
+
+JOURNAL_FILE = 'pipeline_journal.jsonl'
+
+
+class Journal:
+    """
+    Append-only log of pipeline task states at <campaign>/pipeline_journal.jsonl
+
+    Each line records the start, completion (with output sizes and mtimes) or
+    failure of a task, keyed by its harness or workdir relative to the
+    campaign root. The last record of a task determines its state on resume.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.path = root/JOURNAL_FILE
+        self.tasks = dict()
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # last line may be truncated by a crash
+                        continue
+                    self.tasks[(rec['task'], rec['key'])] = rec
+        self.file = open(self.path, 'a')
+
+    def close(self):
+        self.file.close()
+
+    def key(self, path):
+        return str(Path(path).relative_to(self.root))
+
+    def record(self, task, path, state, **fields):
+        rec = dict(time=time.time(), task=task, key=self.key(path), state=state, **fields)
+        self.file.write(json.dumps(rec) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.tasks[(task, rec['key'])] = rec
+
+    def last(self, task, path):
+        return self.tasks.get((task, self.key(path)))
+
+    def completed(self, task, path):
+        """
+        True if the task completed in an earlier run and its outputs are unchanged
+        """
+        rec = self.last(task, path)
+        return bool(rec and rec['state'] == 'done' and
+                    outputs_unchanged(self.root, rec['outputs']))
+
+    def partial(self, task, path):
+        """
+        True if the task was started or failed in an earlier run
+        """
+        rec = self.last(task, path)
+        return bool(rec and rec['state'] != 'done')
+
+
+def available_mem_mb():
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1 << 20)
+
+
+# approx. memory per kAFL/Qemu instance: MEMSIZE in fuzz.sh + Qemu/kAFL overhead
+WORKER_MEM_MB = 1024 + 512
+BUILD_MEM_MB = 4096
+SMATCH_MEM_MB = 4096
+SMATCH_CORES = 4
+TRIAGE_MEM_MB = 4096
+
+
+class ResourcePool:
+    """
+    Free cores and memory (MiB) for pipeline jobs
+
+    Jobs that pin their processes to cores, i.e. kAFL workers, get a
+    contiguous range of cores, the lowest that fits. Other jobs only count
+    against the number of free cores.
+    """
+
+    def __init__(self, ncpu, mem_mb):
+        self.ncpu = ncpu
+        self.mem_mb = mem_mb
+        self.pinned = [False] * ncpu
+        self.free_cores = ncpu
+        self.free_mem = mem_mb
+
+    def find_range(self, cores):
+        run = 0
+        for i, busy in enumerate(self.pinned):
+            run = 0 if busy else run + 1
+            if run == cores:
+                return i - cores + 1
+        return None
+
+    def acquire(self, cores, mem_mb, pinned=False):
+        """
+        Return an allocation (cpu offset, cores, mem_mb) or None if the job
+        does not fit right now. The cpu offset is None for unpinned jobs.
+        """
+        # a job larger than the whole system may still run alone
+        cores = min(cores, self.ncpu)
+        mem_mb = min(mem_mb, self.mem_mb)
+        if cores > self.free_cores or mem_mb > self.free_mem:
+            return None
+
+        offset = None
+        if pinned:
+            offset = self.find_range(cores)
+            if offset is None:
+                return None
+            for i in range(offset, offset + cores):
+                self.pinned[i] = True
+
+        self.free_cores -= cores
+        self.free_mem -= mem_mb
+        return offset, cores, mem_mb
+
+    def release(self, alloc):
+        offset, cores, mem_mb = alloc
+        if offset is not None:
+            for i in range(offset, offset + cores):
+                self.pinned[i] = False
+        self.free_cores += cores
+        self.free_mem += mem_mb
+
 #
 # Task wrappers
 #
 
 
-@python_app
+@python_app(executors=['build'])
 def task_build(args, harness_dir, build_dir, target_dir,
                global_smatch_warns, global_smatch_list):
 
     import os
+    import fcntl
     import subprocess
     import shutil
-
-    target_files = [
-        build_dir/'.config',
-        build_dir/'vmlinux',
-        build_dir/'System.map',
-        build_dir/'arch/x86/boot/bzImage',
+    from pathlib import Path
+
+    kernel_files = [
+        Path('.config'),
+        Path('vmlinux'),
+        Path('System.map'),
+        Path('arch/x86/boot/bzImage')]
+    target_files = kernel_files + [
         global_smatch_warns,
         global_smatch_list]
 
+    outputs = [target_dir/f.name for f in kernel_files]
     os.makedirs(target_dir, exist_ok=True)
 
     if not args.rebuild:
         if all_exist([target_dir/f.name for f in target_files]):
             shutil.rmtree(build_dir)
-            return
+            return output_states(args.campaign_root, outputs)
 
     env = dict(os.environ, MAKEFLAGS=f"-j{args.threads}")
     logfile = build_dir/'task_build.log'
 
-    print(f"Starting build job at {build_dir} (log: {logfile.name})")
+    # harnesses with identical kernel config share a single build
     with open(logfile, 'w') as log:
-        p = subprocess.run([args.fuzz_sh, "build", harness_dir, build_dir],
-                           shell=False, check=True, env=env,
-                           stdout=log, stderr=subprocess.STDOUT)
-
-    if p.returncode != 0:
-        return
+        subprocess.run([args.fuzz_sh, "config", harness_dir, build_dir],
+                       shell=False, check=True, env=env,
+                       stdout=log, stderr=subprocess.STDOUT)
 
-    for f in target_files:
-        shutil.copy(f, target_dir)
-        shutil.copy(logfile, target_dir)
+    cache_dir = args.campaign_root/'build_cache'/build_cache_key(build_dir)
+    os.makedirs(cache_dir.parent, exist_ok=True)
+    with open(f"{cache_dir}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if build_cache_valid(args, cache_dir):
+            print(f"Reusing kernel build {cache_dir.name[:12]} for {harness_dir.name}")
+        else:
+            # with --build-pool, build incrementally in a warm tree instead
+            tree = build_dir
+            slot = args.build_pool.acquire(build_dir/'.config') if args.build_pool else None
+            if slot:
+                tree, slot_lock = slot
+            print(f"Starting build job at {tree} (log: {logfile.name})")
+            try:
+                with open(logfile, 'a') as log:
+                    subprocess.run([args.fuzz_sh, "build", harness_dir, tree],
+                                   shell=False, check=True, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                os.makedirs(cache_dir)
+                for f in kernel_files:
+                    shutil.copy(tree/f, cache_dir)
+                (cache_dir/'complete').touch()
+            finally:
+                if slot:
+                    args.build_pool.release(tree, slot_lock)
+
+    link_files([cache_dir/f.name for f in kernel_files], target_dir)
+    shutil.copy(global_smatch_warns, target_dir)
+    shutil.copy(global_smatch_list, target_dir)
+    shutil.copy(logfile, target_dir)
     if not args.keep:
         shutil.rmtree(build_dir)
+    return output_states(args.campaign_root, outputs)
 
 
-@python_app
-def task_fuzz(args, pipe_id, harness_dir, target_dir, work_dir):
+@python_app(executors=['local_threads'])
+def task_fuzz(args, cpu_offset, harness_dir, target_dir, work_dir):
 
     import os
     import subprocess
 
-    if ((work_dir/'stats').exists() and
-            (work_dir/'worker_stats_0').exists()):
+    outputs = [work_dir/'stats', work_dir/'worker_stats_0']
+    if all_exist(outputs):
         print(f"Skip fuzzing for existing workdir {work_dir}..")
-        return pipe_id
+        return output_states(args.campaign_root, outputs)
 
     env = dict(os.environ, KAFL_WORKDIR=f"{work_dir}")
     logfile = work_dir/'task_fuzz.log'
@@ -129,16 +502,15 @@ def task_fuzz(args, pipe_id, harness_dir, target_dir, work_dir):
     print(f"Starting fuzzer job at {work_dir} (log: {logfile.name})")
     with open(logfile, 'w') as log:
         subprocess.run([args.fuzz_sh, "run", target_dir, *args.kafl_extra,
-                        "--cpu-offset", str(args.workers*pipe_id),
+                        "--cpu-offset", str(cpu_offset),
                         "-p", str(args.workers)],
                        shell=False, check=True, env=env, cwd=harness_dir,
                        stdout=log, stderr=subprocess.STDOUT)
-
-    return pipe_id
+    return output_states(args.campaign_root, outputs)
 
 
-@python_app
-def task_trace(args, harness_dir, work_dir):
+@python_app(executors=['post'])
+def task_trace(args, cpu_offset, harness_dir, work_dir):
 
     import subprocess
 
@@ -146,26 +518,27 @@ def task_trace(args, harness_dir, work_dir):
 
     print(f"Starting trace job at {work_dir} (log: {logfile.name})")
     with open(logfile, 'w') as log:
-        subprocess.run([args.fuzz_sh, "cov", work_dir, "-p", str(args.workers)],
+        subprocess.run([args.fuzz_sh, "cov", work_dir,
+                        "--cpu-offset", str(cpu_offset),
+                        "-p", str(args.workers)],
                        shell=False, check=True, cwd=harness_dir,
                        stdout=log, stderr=subprocess.STDOUT)
+    return output_states(args.campaign_root, patterns=[work_dir/'traces'/'fuzz_*.lst.lz4'])
 
 
-@python_app
-def task_smatch(args, work_dir, smatch_list, wait_task=None):
+@python_app(executors=['post'])
+def task_smatch(args, work_dir, smatch_list):
 
     import os
     import subprocess
 
-    # wait on dependency... :-/
-    if wait_task:
-        wait_task.result()
-
     env = dict(
         os.environ,
         MAKEFLAGS=f"-j{args.threads}",
         USE_GHIDRA=str(int(args.use_ghidra)),
-        USE_FAST_MATCHER=str(int(args.use_fast_matcher)))
+        USE_FAST_MATCHER=str(int(args.use_fast_matcher)),
+        USE_NATIVE_SYMBOLIZER=str(int(args.use_native_symbolizer)),
+        SYMBOL_CACHE_DIR=f"{args.campaign_root/'symbol_cache'}")
     logfile = work_dir/'task_smatch.log'
 
     print(f"Starting smatch job at {work_dir} (log: {logfile.name})")
@@ -173,10 +546,12 @@ def task_smatch(args, work_dir, smatch_list, wait_task=None):
         subprocess.run([args.fuzz_sh, "smatch", work_dir],
                        shell=False, check=True, env=env,
                        stdout=log, stderr=subprocess.STDOUT)
+    outputs = [work_dir/'traces'/f for f in ['addr2line.lst', 'smatch_match.lst', 'linecov.lst']]
+    return output_states(args.campaign_root, [f for f in outputs if f.exists()])
 
 
-@python_app
-def task_triage(args):
+@python_app(executors=['post'])
+def task_triage(args, jobs):
 
     import subprocess
 
@@ -185,7 +560,8 @@ def task_triage(args):
     # generate stats output
     if args.stats_helper.exists():
         with open(args.campaign_root/'stats.log', 'w') as stats_log:
-            subprocess.run([args.stats_helper, '--html', args.campaign_root/'stats.html', args.campaign_root],
+            subprocess.run([args.stats_helper, '--html', args.campaign_root/'stats.html',
+                            '-j', str(jobs), args.campaign_root],
                            shell=False, check=True, stdout=stats_log, stderr=subprocess.STDOUT)
 
     # sort / decode / summarize crash reports
@@ -196,7 +572,7 @@ def task_triage(args):
                            stdout=logfile, stderr=subprocess.STDOUT)
 
 
-@python_app
+@python_app(executors=['post'])
 def task_smatcher(args, pipeline):
 
     import subprocess
@@ -211,13 +587,40 @@ def task_smatcher(args, pipeline):
                            stdout=report, stderr=logfile)
 
 
+def clean_partial(journal, kind, path, delete=False):
+    """
+    Remove the partial results of a task that was interrupted or failed in
+    an earlier run, so that it can be started again. The corpus and crashes
+    of a partial fuzz job are moved aside instead, unless delete is set.
+    """
+    rec = journal.last(kind, path)
+    print(f"Cleaning up partial {kind} job at {path}")
+    if kind == 'build':
+        if rec.get('build_dir'):
+            shutil.rmtree(journal.root/rec['build_dir'], ignore_errors=True)
+        for name in ['.config', 'vmlinux', 'System.map', 'bzImage']:
+            if (path/'target'/name).exists():
+                (path/'target'/name).unlink()
+    elif kind == 'fuzz':
+        if delete:
+            shutil.rmtree(path, ignore_errors=True)
+        elif path.exists() and any(path.iterdir()):
+            partial = path.with_name(f"{path.name}.partial-{time.strftime('%Y%m%d-%H%M%S')}")
+            print(f"Moving partial workdir to {partial}")
+            os.rename(path, partial)
+        os.makedirs(path, exist_ok=True)
+        os.chmod(path, 0o755)
+    elif kind == 'trace':
+        shutil.rmtree(path/'traces', ignore_errors=True)
+
+
 def run_campaign(args, harness_dirs):
     global_smatch_warns = args.asset_root/'smatch_warns.txt'
     global_smatch_list = args.asset_root/'smatch_warns_annotated.txt'
 
     pipeline = list()
     for harness in harness_dirs:
-        workdirs = list(harness.glob('workdir_*'))
+        workdirs = [w for w in harness.glob('workdir_*') if '.partial-' not in w.name]
         if not workdirs or args.refuzz:
             workdirs = [mkjobdir(harness, 'workdir')]
 
@@ -226,65 +629,137 @@ def run_campaign(args, harness_dirs):
                 'harness_name': harness.name,
                 'harness_dir': harness,
                 'target_dir': harness/'target',
-                'build_dir': mkjobdir(harness, 'build'),
+                'build_dir': None,
                 'work_dir': workdir
             })
 
-    build_tasks = []
-    for p in pipeline:
-        t = task_build(
-            args,
-            p['harness_dir'],
-            p['build_dir'],
-            p['target_dir'],
-            global_smatch_warns, global_smatch_list)
-        build_tasks.append(t)
-
-    # wait for all build tasks to complete
-    [t.result() for t in build_tasks]
-
-    # manage available cpu sets based on args.pipes
-    # check for done status and start new jobs in freed pipes
-    pipes = set(list(range(args.pipes)))
-    fuzz_queue = pipeline.copy()
-    fuzz_tasks = []
-    while fuzz_queue and pipes:
-        p = fuzz_queue.pop()
-        t = task_fuzz(
-            args,
-            pipes.pop(),
-            p['harness_dir'],
-            p['target_dir'],
-            p['work_dir'])
-        fuzz_tasks.append(t)
-        while not pipes:
-            time.sleep(2)
-            for t in fuzz_tasks:
-                if t.done():
-                    pipes.add(t.result())
-
-    # wait for remaining fuzz tasks to complete
-    [t.result() for t in fuzz_tasks]
-
-    trace_tasks = []
-    for p in pipeline:
-        t = task_trace(args, p['harness_dir'], p['work_dir'])
-        # t.result()
-        trace_tasks.append(t)
-        t = task_smatch(args, p['work_dir'], global_smatch_list, wait_task=t)
-        # t.result()
-        trace_tasks.append(t)
-
-    # triage does not depend on trace jobs
-    t = task_triage(args)
-    trace_tasks.append(t)
-
-    # wait for all trace jobs to finish
-    [t.result() for t in trace_tasks]
+    # each harness runs build -> fuzz -> trace -> smatch, independent of the
+    # other harnesses. Jobs are started in order of priority, once their
+    # cores and memory are free and their executor is below its limit.
+    resources = ResourcePool(args.ncpu, args.mem)
+    demands = {
+        'fuzz': (args.workers, args.workers*WORKER_MEM_MB, True),
+        'build': (args.workers, BUILD_MEM_MB, False),
+        'smatch': (SMATCH_CORES, SMATCH_MEM_MB, False),
+        'trace': (args.workers, args.workers*WORKER_MEM_MB, True),
+    }
+    triage_demand = (args.workers, TRIAGE_MEM_MB, False)
+    executors = {'fuzz': 'local_threads', 'build': 'build', 'smatch': 'post', 'trace': 'post',
+                 'triage': 'post'}
+    limits = {'local_threads': args.pipes, 'build': args.build_jobs, 'post': args.post_jobs}
+
+    queues = {kind: list() for kind in demands}
+
+    # tasks that completed in an earlier run are skipped, interrupted or
+    # failed ones are cleaned up and started again
+    journal = Journal(args.campaign_root)
+    stages = ['fuzz', 'trace', 'smatch']
+
+    def task_key(kind, item):
+        return item[0]['harness_dir'] if kind == 'build' else item['work_dir']
+
+    def resume(entry, stage):
+        for kind in stages[stages.index(stage):]:
+            if not journal.completed(kind, entry['work_dir']):
+                if journal.partial(kind, entry['work_dir']):
+                    clean_partial(journal, kind, entry['work_dir'], args.clean_partial)
+                queues[kind].append(entry)
+                return
+            print(f"Skip {kind} job for {entry['work_dir']}, completed in an earlier run")
+
+    for harness in harness_dirs:
+        entries = [p for p in pipeline if p['harness_dir'] == harness]
+        if args.rebuild or not journal.completed('build', harness):
+            if journal.partial('build', harness):
+                clean_partial(journal, 'build', harness)
+            # one kernel build per harness, shared by all its workdirs
+            build_dir = mkjobdir(harness, 'build')
+            for p in entries:
+                p['build_dir'] = build_dir
+            queues['build'].append(entries)
+        else:
+            print(f"Skip build job for {harness.name}, completed in an earlier run")
+            for p in entries:
+                resume(p, 'fuzz')
+
+    def start_job(kind, item, alloc):
+        if kind == 'build':
+            return task_build(args, item[0]['harness_dir'], item[0]['build_dir'],
+                              item[0]['target_dir'], global_smatch_warns, global_smatch_list)
+        if kind == 'fuzz':
+            return task_fuzz(args, alloc[0], item['harness_dir'], item['target_dir'],
+                             item['work_dir'])
+        if kind == 'trace':
+            return task_trace(args, alloc[0], item['harness_dir'], item['work_dir'])
+        return task_smatch(args, item['work_dir'], global_smatch_list)
+
+    running = dict()
+    failed = list()
+    triage = None
+    def executor_busy(kind):
+        executor = executors[kind]
+        busy = sum(1 for k, _, _ in running.values() if executors[k] == executor)
+        return busy >= limits[executor]
+
+    while any(queues.values()) or running:
+        for kind in demands:
+            while queues[kind]:
+                if executor_busy(kind):
+                    break
+                alloc = resources.acquire(*demands[kind])
+                if alloc is None:
+                    break
+                item = queues[kind].pop(0)
+                fields = dict()
+                if kind == 'build':
+                    fields['build_dir'] = journal.key(item[0]['build_dir'])
+                journal.record(kind, task_key(kind, item), 'start', **fields)
+                running[start_job(kind, item, alloc)] = (kind, item, alloc)
+
+        # triage does not depend on trace jobs, but its stats.py processes
+        # count against the free cores like any other post job
+        if triage is None and not (queues['build'] or queues['fuzz'] or any(
+                kind in ('build', 'fuzz') for kind, _, _ in running.values())):
+            alloc = None if executor_busy('triage') else resources.acquire(*triage_demand)
+            if alloc is not None:
+                triage = task_triage(args, alloc[1])
+                running[triage] = ('triage', None, alloc)
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for t in done:
+            kind, item, alloc = running.pop(t)
+            resources.release(alloc)
+            if kind == 'triage':
+                continue
+            if t.exception():
+                journal.record(kind, task_key(kind, item), 'failed', error=str(t.exception()))
+                jobs = item if kind == 'build' else [item]
+                print(f"{kind.capitalize()} job failed at {jobs[0]['work_dir']}: {t.exception()}")
+                failed.extend(jobs)
+                continue
+            journal.record(kind, task_key(kind, item), 'done', outputs=t.result())
+            if kind == 'build':
+                for p in item:
+                    resume(p, 'fuzz')
+            elif kind == 'fuzz':
+                queues['trace'].append(item)
+            elif kind == 'trace':
+                queues['smatch'].append(item)
+    journal.close()
+
+    if triage is None:
+        triage = task_triage(args, args.ncpu)
+    triage.result()
 
     # run smatch match analysis
-    t = task_smatcher(args, pipeline)
-    t.result()
+    completed = [p for p in pipeline if p not in failed]
+    if completed:
+        t = task_smatcher(args, completed)
+        t.result()
+
+    if failed:
+        print("Failed jobs:\n%s" % pformat([str(p['work_dir']) for p in failed]))
+        sys.exit(1)
 
 
 def init_campaign(args, campaign_dir):
@@ -329,10 +804,23 @@ def parse_args():
     parser.add_argument('--threads', '-t', type=int, metavar='n', default=32,
                         help='number of SW threads (default: 2*workers)')
 
+    parser.add_argument('--mem', type=int, metavar='MiB', default=None,
+                        help='memory available to the pipeline jobs (default: MemAvailable)')
+    parser.add_argument('--build-jobs', type=int, metavar='n', default=None,
+                        help='max. parallel kernel builds (default: number of pipelines)')
+    parser.add_argument('--post-jobs', type=int, metavar='n', default=None,
+                        help='max. parallel trace/smatch/triage jobs (default: number of pipelines)')
+
+    parser.add_argument('--build-pool', type=float, metavar='GiB', default=None,
+                        help='rebuild kernels incrementally in warm build trees, '
+                             'keeping at most <GiB> of them in <campaign>/build_pool/')
     parser.add_argument('--rebuild', action="store_true",
                         help="rebuild fuzz kernels")
     parser.add_argument('--refuzz', action="store_true",
                         help="ignore existing workdirs in the campaign root (default: resume the pipeline)")
+    parser.add_argument('--clean-partial', action="store_true",
+                        help="delete the workdirs of interrupted or failed fuzz jobs on resume "
+                             "(default: keep them at <workdir>.partial-<timestamp>)")
     parser.add_argument('--dry-run', '-n', action="store_true",
                         help="abort fuzzer after 500 execs")
     parser.add_argument('--keep', action="store_true",
@@ -344,6 +832,8 @@ def parse_args():
                         help="use Ghidra for deriving covered blocks from edges? (default=0)")
     parser.add_argument('--use-fast-matcher', metavar='<0|1>', type=bool, default=False,
                         help="use fast_matcher for coverage mapping? (default=0)")
+    parser.add_argument('--use-native-symbolizer', metavar='<0|1>', type=bool, default=False,
+                        help="symbolize coverage in-process instead of eu-addr2line? (default=0)")
 
     parser.add_argument('--linux-conf', metavar='<file>', default=default_config,
                         help=f"base config for kernel harness (default: {default_config})")
@@ -369,6 +859,7 @@ def parse_args():
 def main():
 
     args = parse_args()
+    args.start_time = time.time()
 
     # if campaign directory does not exist, create based on args
     if not os.path.exists(args.campaign_root):
@@ -401,12 +892,29 @@ def main():
         args.pipes = len(harness_dirs)
         args.threads = 2*(args.ncpu//args.pipes)
 
-    # pipeline concurrency is done via parallel parsl jobs
+    # pipeline concurrency is done via parallel parsl jobs, kernel builds and
+    # trace/smatch post-processing run alongside the fuzz jobs
+    if not args.post_jobs:
+        args.post_jobs = args.pipes
+    if not args.build_jobs:
+        args.build_jobs = args.pipes
+    if not args.mem:
+        args.mem = available_mem_mb()
+    if args.build_pool:
+        args.build_pool = BuildPool(args.campaign_root/'build_pool', int(args.build_pool*1024))
     local_threads = Config(
         executors=[
+            ThreadPoolExecutor(
+                max_threads=args.build_jobs,
+                label='build'
+            ),
             ThreadPoolExecutor(
                 max_threads=args.pipes,
                 label='local_threads'
+            ),
+            ThreadPoolExecutor(
+                max_threads=args.post_jobs,
+                label='post'
             )
         ]
     )
@@ -416,8 +924,8 @@ def main():
     if args.dry_run:
         args.kafl_extra = ["--abort-exec", "500"]
 
-    print("\nExecuting %d harnesses in %d pipelines (%d workers, %d threads, %d cpus).\n" % (
-        len(harness_dirs), args.pipes, args.workers, args.threads, args.ncpu))
+    print("\nExecuting %d harnesses in %d pipelines (%d workers, %d threads, %d cpus, %d MiB).\n" % (
+        len(harness_dirs), args.pipes, args.workers, args.threads, args.ncpu, args.mem))
 
     for i in "321":
         print(f"{i},", end='', flush=True)
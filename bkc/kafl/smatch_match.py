@@ -18,12 +18,21 @@ import sys
 
 import time
 import glob
+import fcntl
 import msgpack
 import lz4.frame as lz4
+import numpy as np
 import re
+import shutil
+import tempfile
 import multiprocessing as mp
 
 from operator import itemgetter
+from collections import deque
+from contextlib import contextmanager
+
+from addr_ranges import SymbolMap, AddressRangeIndex
+from node_index import open_node_index
 
 
 import argparse
@@ -36,29 +45,690 @@ def read_binary_file(filename):
 
 EXIT_IP = 0xffffffffffffffff
 
+# edges are stored as packed 128-bit ints: (src << 64) | dst
+EDGE_MASK = 0xffffffffffffffff
+EXIT_EDGE = (EXIT_IP << 64) | EXIT_IP
+
+# decompressed bytes per read() when streaming lz4 traces
+TRACE_CHUNK_SIZE = 1 << 20
+
+# records per slice when reading a trace back from the trace cache
+CACHE_CHUNK_RECORDS = 1 << 16
+
+# byte -> hex digit value, and bytes that may appear in a trace at all
+HEX_NIBBLES = np.zeros(256, dtype=np.uint64)
+TRACE_BYTES = np.zeros(256, dtype=bool)
+for i, c in enumerate(b'0123456789abcdef'):
+    HEX_NIBBLES[c] = i
+    HEX_NIBBLES[c ^ 0x20] = i
+    TRACE_BYTES[c] = TRACE_BYTES[c ^ 0x20] = True
+TRACE_BYTES[ord(',')] = TRACE_BYTES[ord('\n')] = True
+
+# addr2line.lst entries: the address line with the innermost function,
+# followed by one line per caller the code was inlined into
+ADDR2LINE_RE = re.compile(
+    r"(?:0x([\da-f]+): | \(inlined by\) )(\S+) at (\S+):[0-9]+$", re.MULTILINE)
+
 # default smatch_warns.txt to use if nothing in $WORKDIR/target/
 DEFAULT_SMATCH_FILE = os.path.expandvars("$BKC_ROOT/smatch_warns.txt")
 
+
+def read_trace_records(trace_file, chunk_size=TRACE_CHUNK_SIZE):
+    """
+    Yield (src, dst, num) records from a lz4-compressed kAFL trace.
+
+    The lz4 frame is decoded in chunks of chunk_size bytes and only complete
+    lines are parsed, so memory use is bounded by the chunk size rather than
+    the size of the decompressed trace.
+    """
+    tail = b''
+    with lz4.open(trace_file, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            lines = (tail + chunk).split(b'\n')
+            # keep the incomplete last line for the next chunk
+            tail = lines.pop() if chunk else b''
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    src, dst, num = line.split(b",")
+                except ValueError:
+                    src, dst = line.split(b",")
+                    num = b'1'
+                yield int(src, 16), int(dst, 16), int(num, 16)
+            if not chunk:
+                break
+
+
+def decode_trace_buffer(data):
+    """
+    Decode a buffer of complete src,dst[,num] lines into uint64 arrays.
+
+    Every byte is mapped to its hex digit value and shifted by its distance
+    to the end of its field, so that a single reduceat() over the field
+    boundaries yields all field values at once.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    buf = buf[TRACE_BYTES[buf]]
+    if len(buf) == 0 or buf[-1] != ord('\n'):
+        buf = np.append(buf, np.uint8(ord('\n')))
+
+    is_nl = buf == ord('\n')
+    is_sep = is_nl | (buf == ord(','))
+    sep_idx = np.flatnonzero(is_sep)
+
+    # digit position within its field, counted from the right
+    field_len = np.diff(sep_idx, prepend=-1)
+    field_end = np.repeat(sep_idx, field_len)
+    shift = (field_end - np.arange(len(buf)) - 1) * 4
+    overflow = shift >= 64
+    shift[is_sep | overflow] = 0
+    digits = HEX_NIBBLES[buf] << shift.astype(np.uint64)
+    digits[overflow] = 0
+
+    field_start = np.concatenate(([0], sep_idx[:-1] + 1))
+    fields = np.add.reduceat(digits, field_start)
+
+    # fields per line, skipping empty or malformed lines
+    sep_nl = is_nl[sep_idx].astype(np.int64)
+    line_of_field = np.cumsum(sep_nl) - sep_nl
+    nfields = np.bincount(line_of_field)
+    first = np.cumsum(nfields) - nfields
+    valid = (nfields == 2) | (nfields == 3)
+    first = first[valid]
+    has_num = nfields[valid] == 3
+
+    src = fields[first]
+    dst = fields[first + 1]
+    num = np.ones(len(first), dtype=np.uint64)
+    num[has_num] = fields[first[has_num] + 2]
+    return src, dst, num
+
+
+def read_trace_arrays(trace_file, chunk_size=TRACE_CHUNK_SIZE):
+    """
+    Decode a lz4-compressed kAFL trace into (src, dst, num) uint64 arrays.
+    """
+    srcs, dsts, nums = [], [], []
+    tail = b''
+    with lz4.open(trace_file, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            data = tail + chunk
+            if chunk:
+                cut = data.rfind(b'\n') + 1
+                data, tail = data[:cut], data[cut:]
+            if data:
+                src, dst, num = decode_trace_buffer(data)
+                srcs.append(src)
+                dsts.append(dst)
+                nums.append(num)
+            if not chunk:
+                break
+
+    if not srcs:
+        return (np.zeros(0, dtype=np.uint64),) * 3
+    return np.concatenate(srcs), np.concatenate(dsts), np.concatenate(nums)
+
+
+def unique_rows(*columns):
+    """
+    Return the unique rows over the given uint64 columns, as a 2D array in
+    order of first occurrence, along with the inverse index mapping each
+    input row to its unique row.
+
+    Columns are folded one at a time into a dense int64 row id, which keeps
+    every step a 1D unique() instead of a slow row-wise sort.
+    """
+    row_id = np.unique(columns[0], return_inverse=True)[1]
+    for c in columns[1:-1]:
+        values, inverse = np.unique(c, return_inverse=True)
+        row_id = np.unique(row_id * len(values) + inverse, return_inverse=True)[1]
+    values, inverse = np.unique(columns[-1], return_inverse=True)
+    _, first, row_id = np.unique(row_id * len(values) + inverse,
+                                 return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    first = first[order]
+    return np.stack([c[first] for c in columns], axis=1), rank[row_id]
+
+
+def edges_to_callers(src, dst):
+    """
+    Group unique src->dst edges into a dict of dst -> set(src).
+    """
+    if len(dst) == 0:
+        return dict()
+    order = np.argsort(dst, kind='stable')
+    src, dst = src[order], dst[order]
+    split = np.flatnonzero(np.diff(dst)) + 1
+    starts = np.concatenate(([0], split))
+    return {d: set(srcs.tolist()) for d, srcs in
+            zip(dst[starts].tolist(), np.split(src, split))}
+
+
+def group_by_key(keys, values, order=None):
+    """
+    Yield (key, values) for each distinct key, keeping the order of values.
+    order may pass in a precomputed argsort(keys, kind='stable').
+    """
+    if len(keys) == 0:
+        return iter(())
+    if order is None:
+        order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    split = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate(([0], split))
+    return zip(keys[starts].tolist(), np.split(values, split))
+
+
+class BackEdgeGraph:
+    """
+    Compact graph of edge -> prior edges, collected over all traces
+
+    Links are kept as deduplicated (src, dst, prev_src, prev_dst) uint64
+    columns. On the first query, edges are interned to dense ids in (src, dst)
+    order and the links are turned into a CSR adjacency, so that the prior
+    edges of edge id i are prior[indptr[i]:indptr[i+1]].
+
+    Edge ids are only valid until new links are added: generation is
+    incremented whenever the edges are interned again.
+    """
+
+    COMPACT_SIZE = 1 << 20
+
+    def __init__(self):
+        self.links = np.zeros((4, 0), dtype=np.uint64)
+        self.pending = list()
+        self.num_pending = 0
+        self.src = None
+        self.dst = None
+        self.indptr = None
+        self.prior = None
+        self.generation = 0
+
+    def __len__(self):
+        self.build()
+        return len(self.src)
+
+    def add_links(self, links):
+        """
+        Add a (4, n) array of src, dst, prev_src, prev_dst links
+        """
+        if links.shape[1] == 0:
+            return
+        # copy, links may be mapped from a worker's temp file
+        self.pending.append(np.array(links, dtype=np.uint64))
+        self.num_pending += links.shape[1]
+        self.src = None
+        if self.num_pending >= max(self.COMPACT_SIZE, self.links.shape[1]):
+            self.compact()
+
+    def add_back_edges(self, back_edges):
+        """
+        Add a dict of edge -> set(prior edges) as returned by the trace parsers
+        """
+        links = [(edge >> 64, edge & EDGE_MASK, prior >> 64, prior & EDGE_MASK)
+                 for edge, priors in back_edges.items() for prior in priors]
+        if links:
+            self.add_links(np.array(links, dtype=np.uint64).T)
+
+    def compact(self):
+        if not self.pending:
+            return
+        links = np.concatenate([self.links] + self.pending, axis=1)
+        self.links = np.ascontiguousarray(unique_rows(*links)[0].T)
+        self.pending = list()
+        self.num_pending = 0
+
+    def build(self):
+        if self.src is not None:
+            return
+        self.compact()
+        self.generation += 1
+        num_links = self.links.shape[1]
+        src, dst, prev_src, prev_dst = self.links
+        nodes, inverse = unique_rows(np.concatenate((src, prev_src)),
+                                     np.concatenate((dst, prev_dst)))
+
+        # intern edges in (src, dst) order so lookup() can bisect
+        order = np.lexsort((nodes[:, 1], nodes[:, 0]))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        self.src = np.ascontiguousarray(nodes[order, 0])
+        self.dst = np.ascontiguousarray(nodes[order, 1])
+
+        ids = rank[inverse]
+        child, parent = ids[:num_links], ids[num_links:]
+        order = np.lexsort((parent, child))
+        self.prior = parent[order]
+        self.indptr = np.zeros(len(self.src) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(child, minlength=len(self.src)), out=self.indptr[1:])
+
+    def lookup(self, edge):
+        """
+        Return the id of an edge, or -1 if it was never seen
+        """
+        self.build()
+        src, dst = np.uint64(edge >> 64), np.uint64(edge & EDGE_MASK)
+        lo = np.searchsorted(self.src, src, side='left')
+        hi = np.searchsorted(self.src, src, side='right')
+        i = lo + np.searchsorted(self.dst[lo:hi], dst)
+        if i < hi and self.dst[i] == dst:
+            return int(i)
+        return -1
+
+    def edge(self, i):
+        return (int(self.src[i]) << 64) | int(self.dst[i])
+
+    def prior_ids(self, i):
+        self.build()
+        return self.prior[self.indptr[i]:self.indptr[i+1]]
+
+    def prior_edges(self, edge):
+        i = self.lookup(edge)
+        if i < 0:
+            raise KeyError(edge)
+        return [self.edge(j) for j in self.prior_ids(i).tolist()]
+
+
+class TraceCache:
+    """
+    Persistent cache of decoded trace records in <trace_dir>/trace_cache.bin
+
+    Each trace is stored as one uint64 block holding its src, dst and num
+    columns back to back. trace_cache.idx maps trace names to their
+    (mtime_ns, size, offset, count), so a trace whose file has changed is
+    simply re-decoded and appended. Blocks of stale traces, and entries of
+    traces deleted from trace_dir, are dropped by compacting the file once
+    they take up more than half of it.
+
+    Traces are decoded whole to build their block, so the cache is only
+    used with --cache: it trades memory and disk for faster repeated runs.
+    """
+
+    VERSION = 1
+
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        self.data_file = trace_dir + "/trace_cache.bin"
+        self.index_file = trace_dir + "/trace_cache.idx"
+        self.lock_file = trace_dir + "/trace_cache.lock"
+        self.length = 0
+        self.traces = dict()
+
+    def load(self):
+        self.length = 0
+        self.traces = dict()
+        try:
+            index = msgpack.unpackb(read_binary_file(self.index_file),
+                                    raw=False, strict_map_key=False)
+            size = os.path.getsize(self.data_file)
+        except (OSError, ValueError):
+            return
+        if index.get('version') != self.VERSION or index['length']*8 > size:
+            return
+        self.length = index['length']
+        self.traces = index['traces']
+
+    def save(self):
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(msgpack.packb({
+                'version': self.VERSION,
+                'length': self.length,
+                'traces': self.traces}))
+        os.replace(tmp_file, self.index_file)
+
+    def is_valid(self, trace_file):
+        entry = self.traces.get(os.path.basename(trace_file))
+        if not entry:
+            return False
+        st = os.stat(trace_file)
+        return entry[0] == st.st_mtime_ns and entry[1] == st.st_size
+
+    def lookup(self, trace_file):
+        """
+        Return (data_file, offset, count) for a trace cached by update()
+        """
+        _, _, offset, count = self.traces[os.path.basename(trace_file)]
+        return self.data_file, offset, count
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the cache lock, so that concurrent runs do not compact or
+        extend the cache while we are reading from it
+        """
+        with open(self.lock_file, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield self
+
+    def update(self, nproc, trace_files):
+        """
+        Decode and append any traces that are missing or stale in the cache
+        (the caller must hold the cache lock)
+        """
+        self.load()
+        pruned = self.prune()
+        stale = [t for t in trace_files if not self.is_valid(t)]
+        if not stale and not pruned:
+            return
+
+        with open(self.data_file, 'ab') as f:
+            # drop any unindexed tail left by an interrupted update
+            f.truncate(self.length*8)
+            if stale:
+                print("Updating trace cache with %d/%d traces.." % (len(stale), len(trace_files)))
+                with mp.Pool(nproc) as pool:
+                    for trace_file, block in zip(stale, pool.imap(read_trace_block, stale)):
+                        st = os.stat(trace_file)
+                        block.tofile(f)
+                        self.traces[os.path.basename(trace_file)] = [
+                            st.st_mtime_ns, st.st_size, self.length, block.shape[1]]
+                        self.length += block.size
+        self.compact()
+        self.save()
+
+    def prune(self):
+        """
+        Drop the entries of traces deleted from trace_dir, return their number
+        """
+        present = set(os.listdir(self.trace_dir))
+        deleted = [name for name in self.traces if name not in present]
+        for name in deleted:
+            del self.traces[name]
+        return len(deleted)
+
+    def compact(self):
+        used = sum(3*count for _, _, _, count in self.traces.values())
+        if used*2 > self.length:
+            return
+        if used == 0:
+            # nothing left to copy, e.g. all traces were empty
+            os.truncate(self.data_file, 0)
+            for entry in self.traces.values():
+                entry[2] = 0
+            self.length = 0
+            return
+
+        data = np.memmap(self.data_file, dtype='<u8', mode='r', shape=(self.length,))
+        tmp_file = self.data_file + ".tmp"
+        offset = 0
+        with open(tmp_file, 'wb') as f:
+            for entry in self.traces.values():
+                size = 3*entry[3]
+                data[entry[2]:entry[2]+size].tofile(f)
+                entry[2] = offset
+                offset += size
+        del data
+        os.replace(tmp_file, self.data_file)
+        self.length = offset
+
+
+def imap_window(pool, func, jobs, window):
+    """
+    Ordered pool.imap() with at most <window> jobs in flight.
+
+    Unlike imap(), results are not queued up in the parent when the consumer
+    is slower than the workers.
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def read_trace_block(trace_file):
+    return np.stack(read_trace_arrays(trace_file)).astype('<u8')
+
+
+def read_cached_arrays(data_file, offset, count):
+    if count == 0:
+        return (np.zeros(0, dtype='<u8'),) * 3
+    data = np.memmap(data_file, dtype='<u8', mode='r',
+                     offset=offset*8, shape=(3, count))
+    return data[0], data[1], data[2]
+
+
+def parse_cached_trace(job):
+    """
+    Parse one trace from the trace cache (runs in worker processes)
+    """
+    data_file, offset, count, backend = job
+    src, dst, num = read_cached_arrays(data_file, offset, count)
+    if backend == 'numpy':
+        return TraceParser.parse_splice_arrays(src, dst, num)
+    return TraceParser.parse_splice_records(iter_cached_records(src, dst, num))
+
+
+def iter_cached_records(src, dst, num, chunk=CACHE_CHUNK_RECORDS):
+    """
+    Yield (src, dst, num) records from mapped cache arrays, converting only
+    <chunk> records to Python ints at a time
+    """
+    for i in range(0, len(src), chunk):
+        yield from zip(src[i:i+chunk].tolist(), dst[i:i+chunk].tolist(),
+                       num[i:i+chunk].tolist())
+
+
+def parse_trace_to_file(job):
+    """
+    Parse one trace and write its spliced edges and back-edge links to
+    out_file, returning only their shapes (runs in worker processes)
+    """
+    source, out_file = job
+    if isinstance(source, tuple):
+        src, dst, num = read_cached_arrays(*source)
+    else:
+        print("Processing trace file %s.." % source)
+        src, dst, num = read_trace_arrays(source)
+
+    edges, links = TraceParser.splice_arrays(src, dst, num)
+    with open(out_file, 'wb') as f:
+        edges.astype('<u8').tofile(f)
+        links.astype('<u8').tofile(f)
+    return out_file, edges.shape[1], links.shape[1]
+
+
+def map_trace_file(out_file, num_edges, num_links):
+    """
+    Map the output of parse_trace_to_file() as (edges, links) arrays
+    """
+    size = 3*num_edges + 4*num_links
+    if size == 0:
+        return np.zeros((3, 0), dtype='<u8'), np.zeros((4, 0), dtype='<u8')
+    data = np.memmap(out_file, dtype='<u8', mode='r', shape=(size,))
+    return (data[:3*num_edges].reshape(3, num_edges),
+            data[3*num_edges:].reshape(4, num_links))
+
+
+class Addr2LineIndex:
+    """
+    Parsed addr2line.lst, cached in addr2line.idx next to it
+
+    The index holds the function and file:line string tables and uint64
+    arrays of (addr, func_id, lino_id) entries sorted by address, with
+    entries of the same address kept in file order, plus the orders of the
+    entries by func_id and lino_id. It is rebuilt whenever the mtime or size
+    of addr2line.lst changes.
+
+    Looking up an address returns the (lino, func) of its last, outermost
+    inlined entry.
+    """
+
+    VERSION = 1
+
+    def __init__(self, addr2line_file):
+        self.addr2line_file = addr2line_file
+        self.index_file = os.path.splitext(addr2line_file)[0] + ".idx"
+        self.addrs = np.zeros(0, dtype=np.uint64)
+        self.func_ids = np.zeros(0, dtype=np.int64)
+        self.lino_ids = np.zeros(0, dtype=np.int64)
+        self.func_order = np.zeros(0, dtype=np.int64)
+        self.lino_order = np.zeros(0, dtype=np.int64)
+        self.funcs = list()
+        self.linos = list()
+
+    def __len__(self):
+        return len(np.unique(self.addrs))
+
+    def __contains__(self, addr):
+        return self.find(addr) >= 0
+
+    def __getitem__(self, addr):
+        i = self.find(addr)
+        if i < 0:
+            raise KeyError(addr)
+        return self.linos[self.lino_ids[i]], self.funcs[self.func_ids[i]]
+
+    def find(self, addr):
+        """
+        Return the position of the last entry for addr, or -1
+        """
+        if not 0 <= addr <= EDGE_MASK:
+            return -1
+        i = int(np.searchsorted(self.addrs, np.uint64(addr), side='right')) - 1
+        if i < 0 or int(self.addrs[i]) != addr:
+            return -1
+        return i
+
+    def stat_key(self):
+        st = os.stat(self.addr2line_file)
+        return [st.st_mtime_ns, st.st_size]
+
+    def load(self):
+        try:
+            index = msgpack.unpackb(read_binary_file(self.index_file), raw=False)
+        except (OSError, ValueError):
+            return False
+        if index.get('version') != self.VERSION or index['source'] != self.stat_key():
+            return False
+        entries = np.frombuffer(index['entries'], dtype='<u8').reshape(5, -1)
+        self.addrs = entries[0]
+        self.func_ids, self.lino_ids, self.func_order, self.lino_order = \
+            entries[1:].astype(np.int64)
+        self.funcs = index['funcs']
+        self.linos = index['linos']
+        return True
+
+    def save(self, source):
+        tmp_file = self.index_file + ".tmp"
+        entries = np.stack([c.astype('<u8') for c in (self.addrs, self.func_ids, self.lino_ids,
+                                                      self.func_order, self.lino_order)])
+        with open(tmp_file, 'wb') as f:
+            f.write(msgpack.packb({
+                'version': self.VERSION,
+                'source': source,
+                'funcs': self.funcs,
+                'linos': self.linos,
+                'entries': entries.tobytes()}))
+        os.replace(tmp_file, self.index_file)
+
+    def parse(self):
+        with open(self.addr2line_file, 'r') as f:
+            matches = ADDR2LINE_RE.findall(f.read())
+        count = len(matches)
+        hex_addrs = list(map(itemgetter(0), matches))
+        funcs = list(map(itemgetter(1), matches))
+        linos = list(map(itemgetter(2), matches))
+        del matches
+
+        # inlined-by entries have no address and belong to the one before
+        addrs = np.fromiter((int(a, 16) if a else 0 for a in hex_addrs),
+                            dtype=np.uint64, count=count)
+        has_addr = np.fromiter(map(bool, hex_addrs), dtype=bool, count=count)
+        addrs = addrs[np.maximum.accumulate(np.where(has_addr, np.arange(count), 0))]
+        self.set_entries(addrs, funcs, linos)
+
+    def symbolize(self, elf_file, addrs, cache_dir=None):
+        """
+        Symbolize addrs based on the DWARF info of elf_file, and write the
+        results to addr2line.lst for other tools
+        """
+        from symbolize import symbolize_cached, format_frames
+
+        entry_addrs = list()
+        funcs = list()
+        linos = list()
+        with open(self.addr2line_file, 'w') as f:
+            for addr, frames in symbolize_cached(elf_file, addrs, cache_dir):
+                lines = format_frames(addr, frames)
+                f.write("\n".join(lines) + "\n")
+                # same func and file:line as parsed from these lines
+                for line in lines:
+                    m = ADDR2LINE_RE.search(line)
+                    if m:
+                        entry_addrs.append(addr)
+                        funcs.append(m.group(2))
+                        linos.append(m.group(3))
+        self.set_entries(np.array(entry_addrs, dtype=np.uint64), funcs, linos)
+
+    def set_entries(self, addrs, funcs, linos):
+        count = len(funcs)
+        func_ids = {func: i for i, func in enumerate(dict.fromkeys(funcs))}
+        lino_ids = {lino: i for i, lino in enumerate(dict.fromkeys(linos))}
+        order = np.argsort(addrs, kind='stable')
+        self.addrs = addrs[order]
+        self.func_ids = np.fromiter(map(func_ids.__getitem__, funcs),
+                                    dtype=np.int64, count=count)[order]
+        self.lino_ids = np.fromiter(map(lino_ids.__getitem__, linos),
+                                    dtype=np.int64, count=count)[order]
+        self.func_order = np.argsort(self.func_ids, kind='stable')
+        self.lino_order = np.argsort(self.lino_ids, kind='stable')
+        self.funcs = list(func_ids)
+        self.linos = list(lino_ids)
+
+    def open(self, elf_file=None, addrs=None, cache_dir=None):
+        """
+        Load the index, or parse addr2line.lst and save a new one. If
+        addr2line.lst does not exist yet, generate it from elf_file for addrs.
+        """
+        if not os.path.exists(self.addr2line_file) and elf_file:
+            self.symbolize(elf_file, addrs, cache_dir)
+            self.save(self.stat_key())
+        elif not self.load():
+            source = self.stat_key()
+            self.parse()
+            self.save(source)
+        return self
+
+
 # should reset this between different trace startpoints (-f)
 
 
 class TraceParser:
 
-    def __init__(self, trace_dir):
+    def __init__(self, trace_dir, backend='python', use_cache=False, transport='pickle'):
         self.trace_dir = trace_dir
+        self.backend = backend
+        self.transport = transport
+        self.cache = TraceCache(trace_dir) if use_cache else None
         self.known_bbs = set()
         self.known_edges = set()
         self.trace_results = list()
         self.unique_edges = dict()
         self.unique_bbs = set()
+        self.merged_traces = dict()
+        self.queued_traces = dict()
+        self.num_traces = 0
         self.callers = dict()
         self.addr2lifu = dict()
+        self.addr_ranges = None
         self.line2addr = dict()
         self.func2addr = dict()
         self.smatch_func_map = dict()
         self.smatch_lino_map = dict()
-        self.global_back_edges = dict()
-        self.seen_edges = set()
+        self.global_back_edges = BackEdgeGraph()
+        self.seen_edges = None
+        self.seen_generation = None
+        self.func_callers = dict()
+        self.reach_cache = dict()
         self.func_matches = dict()
         self.lino_matches = dict()
 
@@ -69,15 +739,13 @@ class TraceParser:
     def is_valid_addr(self, addr):
         return addr is not None and addr != 0xffffffffffffffff
 
-    def get_prior_edge_str(self, edge_str):
-        return self.global_back_edges[edge_str]
+    def get_prior_edges(self, edge):
+        return self.global_back_edges.prior_edges(edge)
 
     def get_prior_edge(self, src, dst):
-        # search backward through all collected traces - slooow
-        edge_str = "%016x,%016x" % (src, dst)
-        for prior_edge_str in self.global_back_edges[edge_str]:
-            src, dst = prior_edge_str.split(',')
-            yield ([int(src, 16), int(dst, 16)])
+        # search backward through all collected traces
+        for prior_edge in self.global_back_edges.prior_edges(self.pack_edge(src, dst)):
+            yield self.unpack_edge(prior_edge)
 
     def addr2caller(self, addr):
         return self.callers.get(addr, [None])
@@ -85,12 +753,25 @@ class TraceParser:
     def addr2line(self, addr):
         if addr < 0xffffffff00000000:
             return '0'
-        return self.addr2lifu[addr][0]
+        try:
+            return self.addr2lifu[addr][0]
+        except KeyError:
+            # not a block start, look up the enclosing line range
+            found = self.addr_ranges.lookup(addr) if self.addr_ranges else None
+            if not found or found[1] is None:
+                raise
+            return found[1]
 
     def addr2func(self, addr):
         if addr < 0xffffffff00000000:
             return 'trace_exit'
-        return self.addr2lifu[addr][1]
+        try:
+            return self.addr2lifu[addr][1]
+        except KeyError:
+            found = self.addr_ranges.lookup(addr) if self.addr_ranges else None
+            if not found:
+                raise
+            return found[0]
 
     def func2addrs(self, func):
         if func == 'trace_exit':
@@ -101,13 +782,16 @@ class TraceParser:
         return set([self.addr2line(addr) for addr in self.func2addrs(func)])
 
     @staticmethod
-    def edge_to_str(src, dst):
-        return "%016x,%016x" % (src, dst)
+    def pack_edge(src, dst):
+        return (src << 64) | dst
 
     @staticmethod
-    def edge_str_to_tuple(edge_str):
-        src, dst = edge_str.split(',')
-        return [int(src, 16), int(dst, 16)]
+    def unpack_edge(edge):
+        return [edge >> 64, edge & EDGE_MASK]
+
+    @staticmethod
+    def edge_to_str(edge):
+        return "%016x,%016x" % (edge >> 64, edge & EDGE_MASK)
 
     @staticmethod
     def parse_trace_file(trace_file):
@@ -118,20 +802,10 @@ class TraceParser:
         bbs = set()
         edges = dict()
         callers = dict()
-        with lz4.open(trace_file, 'r') as f:
-            for line in f.read().decode(errors="ignore").splitlines():
-                try:
-                    src, dst, num = line.split(",")
-                except ValueError:
-                    src, dst = line.split(",")
-                    num = '1'
-
-                src = int(src, 16)
-                dst = int(dst, 16)
-                num = int(num, 16)
-                edges["%016x,%016x" % (src, dst)] = num
-                callers.setdefault(dst, set()).add(src)
-                bbs.update({src, dst})
+        for src, dst, num in read_trace_records(trace_file):
+            edges[(src << 64) | dst] = num
+            callers.setdefault(dst, set()).add(src)
+            bbs.update({src, dst})
 
         return {'bbs': bbs, 'edges': edges, 'callers': callers}
 
@@ -142,6 +816,10 @@ class TraceParser:
             return None
         print("Processing trace file %s.." % trace_file)
 
+        return TraceParser.parse_splice_records(read_trace_records(trace_file))
+
+    @staticmethod
+    def parse_splice_records(records):
         splice_ips = set()
 
         def do_splice_location(src, dst):
@@ -155,173 +833,414 @@ class TraceParser:
         callers = dict()
         back_edges = dict()
         prev_ip = 0
-        last_edge = "%016x,%016x" % (EXIT_IP, EXIT_IP)
-        with lz4.open(trace_file, 'r') as f:
-            for line in f.read().decode(errors="ignore").splitlines():
-                try:
-                    src, dst, num = line.split(",")
-                except ValueError:
-                    src, dst = line.split(",")
-                    num = '1'
-
-                src = int(src, 16)
-                dst = int(dst, 16)
-                num = int(num, 16)
-
-                # splice the trace at well-known entry/exit points
-                if dst == EXIT_IP:
-                    assert (prev_ip == 0)
-                    prev_ip = src
-                    # insert fake edge
-                    prev_ip = (src % 0xffffffff << 32) + 0xffffffff
-                    continue
-                if prev_ip != 0:
-                    assert (src == EXIT_IP)
-                    assert (dst != EXIT_IP)
-                    if do_splice_location(prev_ip, dst):
-                        src = prev_ip
-                        prev_ip = 0
-
-                edge_str = "%016x,%016x" % (src, dst)
-                edges[edge_str] = edges.get(edge_str, 0) + num
-                back_edges.setdefault(edge_str, set()).add(last_edge)
-                callers.setdefault(dst, set()).add(src)
-                bbs.update({src, dst})
-                last_edge = edge_str
+        last_edge = EXIT_EDGE
+        for src, dst, num in records:
+            # splice the trace at well-known entry/exit points
+            if dst == EXIT_IP:
+                assert (prev_ip == 0)
+                prev_ip = src
+                # insert fake edge
+                prev_ip = (src % 0xffffffff << 32) + 0xffffffff
+                continue
+            if prev_ip != 0:
+                assert (src == EXIT_IP)
+                assert (dst != EXIT_IP)
+                if do_splice_location(prev_ip, dst):
+                    src = prev_ip
+                    prev_ip = 0
+
+            edge = (src << 64) | dst
+            edges[edge] = edges.get(edge, 0) + num
+            back_edges.setdefault(edge, set()).add(last_edge)
+            callers.setdefault(dst, set()).add(src)
+            bbs.update({src, dst})
+            last_edge = edge
+
+        return {'bbs': bbs, 'edges': edges, 'callers': callers, 'back_edges': back_edges}
+
+    @staticmethod
+    def parse_splice_trace_file_np(trace_file):
+        if not os.path.isfile(trace_file):
+            print("Could not find trace file %s, skipping.." % trace_file)
+            return None
+        print("Processing trace file %s.." % trace_file)
+
+        return TraceParser.parse_splice_arrays(*read_trace_arrays(trace_file))
+
+    @staticmethod
+    def splice_arrays(src, dst, num):
+        """
+        Splice a decoded trace and return its unique edges as a (3, n) array
+        of src, dst, count and its back-edge links as a (4, m) array of
+        src, dst, prev_src, prev_dst, both in order of first occurrence.
+        """
+        # splice the trace at well-known entry/exit points: drop the exit
+        # record and let the next record start from a fake edge
+        is_exit = dst == EXIT_IP
+        exits = np.flatnonzero(is_exit[:-1])
+        assert (not is_exit[exits + 1].any())
+        assert ((src[exits + 1] == EXIT_IP).all())
+        src = src.copy()
+        src[exits + 1] = ((src[exits] % 0xffffffff) << np.uint64(32)) + 0xffffffff
+        keep = ~is_exit
+        src, dst, num = src[keep], dst[keep], num[keep]
+
+        if len(src) == 0:
+            return np.zeros((3, 0), dtype=np.uint64), np.zeros((4, 0), dtype=np.uint64)
+
+        pairs, inverse = unique_rows(src, dst)
+        # sum in uint64, bincount() weights would go through float64
+        counts = np.zeros(len(pairs), dtype=np.uint64)
+        np.add.at(counts, inverse, num.astype(np.uint64))
+
+        # each edge is preceded by the edge before it, the first by EXIT_EDGE
+        exit_ip = np.array([EXIT_IP], dtype=np.uint64)
+        prev_src = np.concatenate((exit_ip, src[:-1]))
+        prev_dst = np.concatenate((exit_ip, dst[:-1]))
+        links, _ = unique_rows(src, dst, prev_src, prev_dst)
+
+        return np.stack((pairs[:, 0], pairs[:, 1], counts)), links.T
+
+    @staticmethod
+    def parse_splice_arrays(src, dst, num):
+        (usrc, udst, counts), links = TraceParser.splice_arrays(src, dst, num)
+
+        edges = {(s << 64) | d: n for s, d, n in
+                 zip(usrc.tolist(), udst.tolist(), counts.tolist())}
+        back_edges = dict()
+        for s, d, ps, pd in zip(*links.tolist()):
+            back_edges.setdefault((s << 64) | d, set()).add((ps << 64) | pd)
+        callers = edges_to_callers(usrc, udst)
+        bbs = set(np.unique(np.concatenate((usrc, udst))).tolist())
 
         return {'bbs': bbs, 'edges': edges, 'callers': callers, 'back_edges': back_edges}
 
     def parse_trace_list(self, nproc, input_list):
         trace_files = list()
+        nids = list()
         timestamps = list()
 
+        self.queued_traces = dict()
         for input_file, nid, timestamp in input_list:
             #trace_file = self.trace_dir + "/" + os.path.basename(input_file) + ".lz4"
             trace_file = "%s/fuzz_%05d.lst.lz4" % (self.trace_dir, nid)
             if os.path.exists(trace_file):
+                # skip traces already merged by a previous incremental run
+                name = os.path.basename(trace_file)
+                if name in self.merged_traces:
+                    continue
+                st = os.stat(trace_file)
+                self.queued_traces[nid] = (name, st.st_size, st.st_mtime_ns)
                 trace_files.append(trace_file)
+                nids.append(nid)
                 timestamps.append(timestamp)
             else:
                 print("Could not find trace: %s => %s" %
                       (input_file, trace_file))
-        print("Parsing trace: %s => %s" % (input_file, trace_file))
+        print("Parsing %d traces from %s.." % (len(trace_files), self.trace_dir))
 
         print("Parsing traces on %d/%d cores..." % (nproc, os.cpu_count()))
+        self.trace_results = self.iter_trace_results(nproc, nids, timestamps, trace_files)
+
+    def iter_trace_results(self, nproc, nids, timestamps, trace_files):
+        """
+        Yield (nid, timestamp, findings) in input order as the workers finish.
+
+        Results are consumed one at a time by gen_reports(), and at most
+        2*nproc traces are in flight, so parent memory is bounded by the
+        merged state rather than by the number of traces.
+        """
+        window = 2*nproc
+        if self.transport == 'mmap':
+            yield from self.iter_mapped_results(nproc, nids, timestamps, trace_files)
+            return
+
+        if self.cache:
+            with self.cache.locked():
+                self.cache.update(nproc, trace_files)
+                jobs = [self.cache.lookup(t) + (self.backend,) for t in trace_files]
+                with mp.Pool(nproc) as pool:
+                    yield from zip(nids, timestamps,
+                                   imap_window(pool, parse_cached_trace, jobs, window))
+            return
+
+        with mp.Pool(nproc) as pool:
+            yield from zip(nids, timestamps,
+                           imap_window(pool, TRACE_BACKENDS[self.backend], trace_files, window))
+
+    def iter_mapped_results(self, nproc, nids, timestamps, trace_files):
+        """
+        Like iter_trace_results(), but workers write their spliced edges and
+        links to temp files and only return the file name and array shapes.
+        The parent maps each file read-only and merges straight from the
+        mapping, so no results are pickled through the pool.
+        """
+        window = 2*nproc
+        tmp_base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        tmp_dir = tempfile.mkdtemp(prefix='smatch_match.', dir=tmp_base)
+        try:
+            if self.cache:
+                with self.cache.locked():
+                    self.cache.update(nproc, trace_files)
+                    sources = [self.cache.lookup(t) for t in trace_files]
+                    yield from self._iter_mapped_jobs(nproc, nids, timestamps, sources, tmp_dir, window)
+            else:
+                yield from self._iter_mapped_jobs(nproc, nids, timestamps, trace_files, tmp_dir, window)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _iter_mapped_jobs(self, nproc, nids, timestamps, sources, tmp_dir, window):
+        jobs = [(source, "%s/%d.bin" % (tmp_dir, i)) for i, source in enumerate(sources)]
         with mp.Pool(nproc) as pool:
-            self.trace_results = zip(timestamps,
-                                     pool.map(TraceParser.parse_splice_trace_file, trace_files))
+            for nid, timestamp, result in zip(nids, timestamps,
+                                              imap_window(pool, parse_trace_to_file, jobs, window)):
+                yield nid, timestamp, {'packed': map_trace_file(*result)}
+                os.unlink(result[0])
 
-    def parse_addr2line(self):
+    def parse_addr2line(self, elf_file=None, symbol_cache=None):
         # parse addr2line DB generated from eu-addr2line -afi < unique_edges.lst
+        # or, with elf_file, symbolize the unique edges in-process
         addr2line = self.trace_dir + "/addr2line.lst"
+        edges_file = self.trace_dir + "/edges_uniq.lst"
 
+        addrs = None
         if not os.path.exists(addr2line):
-            print("Could not find %s." % addr2line)
-            sys.exit(1)
+            if not elf_file or not os.path.exists(edges_file):
+                print("Could not find %s." % addr2line)
+                sys.exit(1)
+            addrs = set()
+            with open(edges_file, 'r') as f:
+                for line in f:
+                    src, dst, _ = line.split(',', 2)
+                    addrs.add(int(src, 16))
+                    addrs.add(int(dst, 16))
+            print("Symbolizing %d unique blocks using %s.." % (len(addrs), elf_file),
+                  file=sys.stderr)
+
+        index = Addr2LineIndex(addr2line).open(elf_file, addrs, symbol_cache)
+        self.addr2lifu = index
+
+        system_map = os.path.join(os.path.dirname(self.trace_dir), "target/System.map")
+        symbols = SymbolMap(system_map) if os.path.exists(system_map) else None
+        self.addr_ranges = AddressRangeIndex(index, symbols)
+        for i, group in group_by_key(index.lino_ids, index.addrs, index.lino_order):
+            self.line2addr[index.linos[i]] = group.tolist()
+        for i, group in group_by_key(index.func_ids, index.addrs, index.func_order):
+            self.func2addr[index.funcs[i]] = set(group.tolist())
+
+    def load_coverage_state(self):
+        """
+        Restore unique BBs/edges from a previous gen_reports(), so that only
+        traces not merged by it are parsed and appended to coverage.csv.
+        The state is discarded if any merged trace was changed or removed.
+
+        Callers and back edges are not part of the saved state, so callsite
+        queries still need a full parse.
+        """
+        state_file = self.trace_dir + "/coverage.state"
+        plot_file = self.trace_dir + "/coverage.csv"
 
-        #print("Parsing addr2line dump at %s" % addr2line)
-        addr = 0
-        with open(addr2line, 'r') as f:
-            for line in f.read().splitlines():
-                m = re.search("0x([\da-f]+): ([\S]+) at ([\S]+):[0-9]+$", line)
-                if m:
-                    addr = int(m.group(1), 16)
-                    func = m.group(2)
-                    lino = m.group(3)
-                    #print(f"parse addr2line: {line}: '{func}' @ '{lino}'")
-                    self.addr2lifu[addr] = (lino, func)
-                    self.line2addr.setdefault(lino, list()).append(addr)
-                    self.func2addr.setdefault(func, set()).add(addr)
-                else:
-                    m = re.search(
-                        " \(inlined by\) ([\S]+) at ([\S]+):[0-9]+$", line)
-                    if m:
-                        # addr = previous addr
-                        func = m.group(1)
-                        lino = m.group(2)
-                        #print(f"parse addr2line: {line}: '{func}' @ '{lino}'")
-                        self.addr2lifu[addr] = (lino, func)
-                        self.line2addr.setdefault(lino, list()).append(addr)
-                        self.func2addr.setdefault(func, set()).add(addr)
+        try:
+            state = msgpack.unpackb(read_binary_file(state_file), raw=False)
+            plot_size = os.path.getsize(plot_file)
+        except (OSError, ValueError):
+            print("No previous coverage state found, processing all traces..")
+            return False
+
+        if state.get('version') != 2 or state['plot_size'] != plot_size:
+            print("Coverage state does not match %s, processing all traces.." % plot_file)
+            return False
+        for name, (size, mtime_ns) in state['traces'].items():
+            try:
+                st = os.stat(os.path.join(self.trace_dir, name))
+            except OSError:
+                st = None
+            if not st or (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                print("Trace %s changed since the last run, processing all traces.." % name)
+                return False
+
+        src, dst, num = np.frombuffer(state['edges'], dtype='<u8').reshape(3, -1)
+        self.unique_edges = {(s << 64) | d: n for s, d, n in
+                             zip(src.tolist(), dst.tolist(), num.tolist())}
+        self.unique_bbs = set(np.frombuffer(state['bbs'], dtype='<u8').tolist())
+        self.merged_traces = state['traces']
+        self.num_traces = state['num_traces']
+
+        print("Resuming coverage of %d traces.." % self.num_traces)
+        return True
+
+    def save_coverage_state(self):
+        state_file = self.trace_dir + "/coverage.state"
+        plot_file = self.trace_dir + "/coverage.csv"
+
+        count = len(self.unique_edges)
+        edges = np.concatenate((
+            np.fromiter((e >> 64 for e in self.unique_edges), dtype='<u8', count=count),
+            np.fromiter((e & EDGE_MASK for e in self.unique_edges), dtype='<u8', count=count),
+            np.fromiter(self.unique_edges.values(), dtype='<u8', count=count)))
+        bbs = np.fromiter(self.unique_bbs, dtype='<u8', count=len(self.unique_bbs))
+
+        tmp_file = state_file + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(msgpack.packb({
+                'version': 2,
+                'traces': self.merged_traces,
+                'num_traces': self.num_traces,
+                'plot_size': os.path.getsize(plot_file),
+                'bbs': bbs.tobytes(),
+                'edges': edges.tobytes()}))
+        os.replace(tmp_file, state_file)
+
+    def merge_findings(self, findings):
+        """
+        Merge the results of one trace, return the number of new BBs and edges
+        """
+        if 'packed' in findings:
+            return self.merge_packed(*findings['packed'])
+
+        new_bbs = len(findings['bbs'] - self.unique_bbs)
+        new_edges = len(findings['edges'].keys() - self.unique_edges.keys())
+        self.unique_bbs.update(findings['bbs'])
+        # self.callers.update(findings['callers'])
+        for dst, srcs in findings['callers'].items():
+            self.callers.setdefault(dst, set()).update(srcs)
+        edges = findings['edges']
+        for edge, num in edges.items():
+            self.unique_edges[edge] = self.unique_edges.get(edge, 0) + num
+        self.global_back_edges.add_back_edges(findings['back_edges'])
+        return new_bbs, new_edges
+
+    def merge_packed(self, edges, links):
+        """
+        Merge the (edges, links) arrays of one trace from parse_trace_to_file()
+        """
+        src, dst, counts = edges
+        bbs = set(np.unique(np.concatenate((src, dst))).tolist())
+        new_bbs = len(bbs - self.unique_bbs)
+        self.unique_bbs.update(bbs)
+        for d, srcs in edges_to_callers(src, dst).items():
+            self.callers.setdefault(d, set()).update(srcs)
+
+        new_edges = 0
+        for s, d, n in zip(src.tolist(), dst.tolist(), counts.tolist()):
+            edge = (s << 64) | d
+            num = self.unique_edges.get(edge)
+            if num is None:
+                new_edges += 1
+                num = 0
+            self.unique_edges[edge] = num + n
+
+        self.global_back_edges.add_links(links)
+        return new_bbs, new_edges
+
+    def merge_traces(self, plot=None):
+        """
+        Merge the results of parse_trace_list(). With plot, a coverage.csv
+        row is written to it for each trace. Returns the number of traces.
+        """
+        # new callers invalidate the memoized caller queries
+        self.func_callers = dict()
+        self.reach_cache = dict()
+        num_bbs = len(self.unique_bbs)
+        num_edges = len(self.unique_edges)
+        num_traces = 0
+        for nid, timestamp, findings in self.trace_results:
+            if not findings:
+                continue
+
+            new_bbs, new_edges = self.merge_findings(findings)
+
+            name, size, mtime_ns = self.queued_traces[nid]
+            self.merged_traces[name] = [size, mtime_ns]
+            num_traces += 1
+            num_bbs += new_bbs
+            num_edges += new_edges
+            if plot:
+                plot.write("%d;%d;%d\n" % (timestamp, num_bbs, num_edges))
+                plot.flush()
+
+        self.num_traces += num_traces
+        return num_traces
 
     def gen_reports(self):
 
         plot_file = self.trace_dir + "/coverage.csv"
         edges_file = self.trace_dir + "/edges_uniq.lst"
 
-        with open(plot_file, 'w') as f:
-            num_bbs = 0
-            num_edges = 0
-            num_traces = 0
-            for timestamp, findings in self.trace_results:
-                if not findings:
-                    continue
-
-                new_bbs = len(findings['bbs'] - self.unique_bbs)
-                new_edges = len(set(findings['edges']) - set(self.unique_edges))
-                self.unique_bbs.update(findings['bbs'])
-                # self.callers.update(findings['callers'])
-                for dst, srcs in findings['callers'].items():
-                    self.callers.setdefault(dst, set()).update(srcs)
-                edges = findings['edges']
-                for edge, num in edges.items():
-                    self.unique_edges[edge] = self.unique_edges.get(edge, 0) + num
-                back_edges = findings['back_edges']
-                for dst, src_set in back_edges.items():
-                    self.global_back_edges.setdefault(dst, set()).update(src_set)
-
-                num_traces += 1
-                num_bbs += new_bbs
-                num_edges += new_edges
-                f.write("%d;%d;%d\n" % (timestamp, num_bbs, num_edges))
+        # append to the coverage.csv of a run restored by load_coverage_state()
+        mode = 'a' if self.merged_traces else 'w'
+        with open(plot_file, mode) as f:
+            num_traces = self.merge_traces(plot=f)
+        num_bbs = len(self.unique_bbs)
+        num_edges = len(self.unique_edges)
 
         with open(edges_file, 'w') as f:
             for edge, num in self.unique_edges.items():
-                f.write("%s,%x\n" % (edge, num))
+                f.write("%016x,%016x,%x\n" % (edge >> 64, edge & EDGE_MASK, num))
 
-        print(" Processed %d traces with a total of %d BBs (%d edges)."
-              % (num_traces, num_bbs, num_edges))
+        self.save_coverage_state()
+
+        print(" Processed %d new traces, %d in total with %d BBs (%d edges)."
+              % (num_traces, self.num_traces, num_bbs, num_edges))
 
         print(" Plot data written to %s" % plot_file)
         print(" Unique edges written to %s" % edges_file)
 
         return
 
-    def callsite_trace_edge(self, edge_str, levels, level=0):
-
-        if level > levels:
-            print("%s abort trace at max level %d..)" % ("->", level))
-            return True
-        if edge_str == "%016x,%016x" % (EXIT_IP, EXIT_IP):
-            print("%s exit_ip..)" % ("->"))
-            return True
-
-        if edge_str in self.seen_edges:
-            #print("%sstop on seen edge..)" % ("|"*level))
+    def callsite_trace_edge(self, edge, levels, level=0):
+        """
+        Walk back from edge through the prior edges of all traces, depth-first
+        and up to <levels>, and report smatch line matches along the way.
+        Edges are only visited once until seen_edges is reset, which also
+        happens whenever the graph re-interned its edge ids.
+        """
+        graph = self.global_back_edges
+        size = (len(graph) + 7) >> 3
+        if self.seen_generation != graph.generation:
+            self.seen_edges = bytearray(size)
+            self.seen_generation = graph.generation
+        seen = self.seen_edges
+
+        start = graph.lookup(edge)
+        if start < 0:
             return False
 
-        self.seen_edges.add(edge_str)
-
-        for addr_str in edge_str.split(','):
-            addr = int(addr_str, 16)
-            func = self.addr2func(addr)
-            lino = self.addr2line(addr)
-            for func in self.smatch_lino_map.get(lino, []):
-                print("%s l_match: %24s at %016x, %s, src: %s" %
-                      ("->", func, addr, lino, self.addr2line(addr)))
-                return True
-
         any_found = False
-        for prior_edge_str in self.get_prior_edge_str(edge_str):
-            #print("%sprior edge: %016x,%016x" % ("| "*level, edge[0], edge[1]))
-            #self.print_addr(edge[0], prefix="| "*level)
-            found = self.callsite_trace_edge(
-                prior_edge_str, levels, level=level+1)
+        stack = [(start, level)]
+        while stack:
+            i, level = stack.pop()
+            edge = graph.edge(i)
+
+            if level > levels:
+                print("%s abort trace at max level %d..)" % ("->", level))
+                any_found = True
+                continue
+            if edge == EXIT_EDGE:
+                print("%s exit_ip..)" % ("->"))
+                any_found = True
+                continue
+
+            if seen[i >> 3] & (1 << (i & 7)):
+                continue
+            seen[i >> 3] |= 1 << (i & 7)
+
+            found = False
+            for addr in self.unpack_edge(edge):
+                lino = self.addr2line(addr)
+                for func in self.smatch_lino_map.get(lino, []):
+                    print("%s l_match: %24s at %016x, %s, src: %s" %
+                          ("->", func, addr, lino, self.addr2line(addr)))
+                    found = True
+                    break
+                if found:
+                    break
             if found:
-                #src = self.edge_str_to_tuple(prior_edge_str)[0]
-                #print("%s via: %s - %s" % ("| ", edge_str, self.addr2func(src)))
-                pass
-            any_found |= found
+                any_found = True
+                continue
+
+            # push in reverse so prior edges are walked in order
+            stack.extend((j, level+1) for j in reversed(graph.prior_ids(i).tolist()))
         return any_found
 
     def callsite_trace_func(self, func, levels=4):
@@ -331,10 +1250,11 @@ class TraceParser:
             #print("trace_by_func(%s) -> %016x" % (func, addr))
             for src in self.addr2caller(addr):
                 if src:
-                    edge_str = "%016x,%016x" % (src, addr)
-                    self.callsite_trace_edge(edge_str, levels, level=1)
+                    self.callsite_trace_edge(self.pack_edge(src, addr), levels, level=1)
 
-    def print_callers(self, func, levels=4, level=0, seen_callers=set()):
+    def print_callers(self, func, levels=4, level=0, seen_callers=None):
+        if seen_callers is None:
+            seen_callers = set()
         callers = set()
 
         try:
@@ -359,7 +1279,9 @@ class TraceParser:
                     self.print_callers(
                         func, levels, level=level+1, seen_callers=seen_callers)
 
-    def collect_callers(self, func, levels=4, level=0, seen_callers=set()):
+    def collect_callers(self, func, levels=4, level=0, seen_callers=None):
+        if seen_callers is None:
+            seen_callers = set()
         callers = set()
 
         try:
@@ -387,7 +1309,96 @@ class TraceParser:
         return result
 
 
-def kafl_workdir_iterator(work_dir):
+    def get_func_callers(self, func):
+        """
+        Return the valid caller addresses of func and the functions they
+        belong to, memoized in func_callers. A function only known from
+        System.map, without addresses in addr2line data, has no known callers.
+        """
+        if func not in self.func_callers:
+            callers = set()
+            try:
+                addrs = self.func2addrs(func)
+            except KeyError:
+                addrs = []
+            for addr in addrs:
+                for caller in self.addr2caller(addr):
+                    if self.is_valid_addr(caller):
+                        callers.add(caller)
+            funcs = set(self.addr2func(addr) for addr in callers)
+            self.func_callers[func] = (frozenset(callers), funcs)
+        return self.func_callers[func]
+
+    def collect_callers_batch(self, funcs, levels=4):
+        """
+        Collect the callers of several functions at once, returning a dict of
+        func -> set of caller addresses up to <levels> calls away.
+
+        The caller graph is expanded as one multi-source BFS from all funcs,
+        then the caller sets are built bottom-up as
+          reach(f, 0) = callers(f)
+          reach(f, n) = callers(f) | reach(g, n-1) for all caller funcs g
+        The per-function callers and the reach(f, n) sets are memoized, so
+        shared parts of the caller graph are only walked once, also across
+        calls. Unlike collect_callers(), results do not depend on query order.
+        """
+        valid = list()
+        for func in funcs:
+            try:
+                self.func2addrs(func)
+            except KeyError:
+                print("Error: Could not find »%s« in addr2line data." % func)
+                continue
+            valid.append(func)
+
+        # need[n] holds the functions whose reach(f, n) is still missing
+        need = [set() for _ in range(levels + 1)]
+        need[levels] = set(f for f in valid if (f, levels) not in self.reach_cache)
+        for n in range(levels, 0, -1):
+            for func in need[n]:
+                for caller_func in self.get_func_callers(func)[1]:
+                    if (caller_func, n-1) not in self.reach_cache:
+                        need[n-1].add(caller_func)
+
+        for n in range(levels + 1):
+            for func in need[n]:
+                callers, caller_funcs = self.get_func_callers(func)
+                reach = set(callers)
+                if n > 0:
+                    for caller_func in caller_funcs:
+                        reach |= self.reach_cache[(caller_func, n-1)]
+                self.reach_cache[(func, n)] = frozenset(reach)
+
+        return {func: set(self.reach_cache[(func, levels)]) for func in valid}
+
+
+TRACE_BACKENDS = {
+    'python': TraceParser.parse_splice_trace_file,
+    'numpy': TraceParser.parse_splice_trace_file_np,
+}
+
+
+def sample_evenly(items, count):
+    """
+    Pick count items at evenly spaced positions, keeping their order
+    """
+    if count is None or len(items) <= count:
+        return items
+    if count <= 0:
+        return []
+    step = len(items) / count
+    return [items[int(i * step)] for i in range(count)]
+
+
+def kafl_workdir_iterator(work_dir, threads=None, sample=None):
+    """
+    Return [input_file, id, seconds] for all inputs in a kAFL workdir.
+
+    Node metadata is taken from the NodeIndex of the workdir, which first
+    reads any new or modified metadata files. With sample=<n>, at most n
+    inputs of each non-regular type (crash, timeout, kasan) are kept,
+    spread evenly over the ascending payload ids.
+    """
     input_id_time = list()
     start_time = time.time()
     for stats_file in glob.glob(work_dir + "/slave_stats_*"):
@@ -398,32 +1409,31 @@ def kafl_workdir_iterator(work_dir):
             raw=False, strict_map_key=False)
         start_time = min(start_time, slave_stats['start_time'])
 
-    # enumerate inputs from corpus/ and match against metainfo in metadata/
-    # TODO: Tracing crashes/timeouts has minimal overall improvement ~1-2%
-    # Probably want to make this optional, and only trace a small sample
-    # of non-regular payloads by default?
-    for input_file in glob.glob(work_dir + "/corpus/[ctrk]*/*"):
-        if not input_file:
-            return None
-        input_id = os.path.basename(input_file).replace("payload_", "")
-        meta_file = work_dir + "/metadata/node_{}".format(input_id)
-        metadata = msgpack.unpackb(
-            read_binary_file(meta_file),
-            raw=False, strict_map_key=False)
-
-        seconds = metadata["info"]["time"] - start_time
-        nid = metadata["id"]
-
-        input_id_time.append([input_file, nid, seconds])
+    # enumerate inputs from the node index, built from metadata/
+    # Tracing crashes/timeouts has minimal overall improvement ~1-2%, so
+    # optionally only trace a sample of the non-regular payloads
+    index = open_node_index(work_dir, threads=threads)
+    by_dir = dict()
+    for node in index.nodes():
+        if node['payload']:
+            by_dir.setdefault(os.path.dirname(node['payload']), list()).append(node)
+    index.close()
+
+    for input_dir, nodes in sorted(by_dir.items()):
+        if input_dir != "corpus/regular":
+            nodes = sample_evenly(nodes, sample)
+        for node in nodes:
+            input_file = work_dir + "/" + node['payload']
+            input_id_time.append([input_file, node['id'], node['time'] - start_time])
 
     return input_id_time
 
 
-def get_inputs_by_time(data_dir):
+def get_inputs_by_time(data_dir, threads=None, sample=None):
     if (os.path.exists(data_dir + "/stats") and
             os.path.isdir(data_dir + "/corpus/regular") and
             os.path.isdir(data_dir + "/metadata")):
-        input_data = kafl_workdir_iterator(data_dir)
+        input_data = kafl_workdir_iterator(data_dir, threads=threads, sample=sample)
     else:
         print("Unrecognized target directory type «%s». Exit." % data_dir)
         sys.exit()
@@ -478,12 +1488,38 @@ def main():
     parser = argparse.ArgumentParser(description='kAFL Trace Processing.')
     parser.add_argument('work_dir', metavar='<work_dir>', type=str,
                         help='target workdir with trace files in /traces/')
-    parser.add_argument('-f', '--func', metavar='<func>', type=str,
-                        help='function to search for')
+    parser.add_argument('-f', '--func', metavar='<func>', type=str, nargs='+',
+                        help='function(s) to search for')
+    parser.add_argument('--func-list', metavar='<file>', type=str,
+                        help='file with functions to search for, one per line')
     parser.add_argument('-p', metavar='<n>', type=int, default=default_nproc(),
                         help='number of threads')
     parser.add_argument('-l', metavar='<n>', type=int, default=2,
                         help='max call depths to search')
+    parser.add_argument('--backend', choices=TRACE_BACKENDS.keys(), default='python',
+                        help='trace parser backend (default: python)')
+    parser.add_argument('--transport', choices=['pickle', 'mmap'], default='pickle',
+                        help='how workers return results: pickled through the pool, or via '
+                             'memory-mapped temp files (implies numpy splicing, default: pickle)')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep decoded traces in <work_dir>/traces/trace_cache.bin for '
+                             'faster repeated runs (decodes each trace in memory, default: off)')
+    parser.add_argument('--symbolize', action='store_true',
+                        help='if <work_dir>/traces/addr2line.lst is missing, generate it from '
+                             'the DWARF info of <work_dir>/target/vmlinux (requires pyelftools)')
+    parser.add_argument('--symbol-cache', metavar='<dir>', type=str,
+                        default=os.environ.get('SYMBOL_CACHE_DIR'),
+                        help='with --symbolize, share results per vmlinux build-id in <dir> '
+                             '(default: $SYMBOL_CACHE_DIR)')
+    parser.add_argument('--meta-threads', metavar='<n>', type=int, default=None,
+                        help='threads for reading input metadata (default: Python default)')
+    parser.add_argument('--sample', metavar='<n>', type=int, default=None,
+                        help='only trace up to <n> crash, timeout and kasan inputs each '
+                             '(default: trace all)')
+    parser.add_argument('--coverage', action='store_true',
+                        help='only generate coverage.csv and edges_uniq.lst from the traces')
+    parser.add_argument('--incremental', action='store_true',
+                        help='with --coverage, only process traces added since the last run')
 
     args = parser.parse_args()
 
@@ -492,6 +1528,17 @@ def main():
     if not os.path.isdir(trace_dir):
         sys.exit(f"Error: Could not find {trace_dir}.")
 
+    traces = TraceParser(trace_dir, backend=args.backend, use_cache=args.cache,
+                         transport=args.transport)
+
+    if args.coverage:
+        if args.incremental:
+            traces.load_coverage_state()
+        traces.parse_trace_list(args.p, get_inputs_by_time(
+            args.work_dir, threads=args.meta_threads, sample=args.sample))
+        traces.gen_reports()
+        return
+
     target_smatch_file = args.work_dir + "/target/smatch_warns.txt"
     if os.path.exists(target_smatch_file):
         smatch_file = target_smatch_file
@@ -500,9 +1547,32 @@ def main():
     else:
         sys.exit(f"Error: Could not find smatch report at {target_smatch_file} or {DEFAULT_SMATCH_FILE}.")
 
-    # TraceParse is not really used, just borrowing addr2line parser..
-    traces = TraceParser(trace_dir)
-    traces.parse_addr2line()
+    if args.symbolize:
+        traces.parse_addr2line(elf_file=args.work_dir + "/target/vmlinux",
+                               symbol_cache=args.symbol_cache)
+    else:
+        traces.parse_addr2line()
+
+    funcs = list(args.func or [])
+    if args.func_list:
+        with open(args.func_list, 'r') as f:
+            for line in f.read().splitlines():
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    funcs.append(line)
+
+    # with -f or --func-list, parse the traces and show the known callers
+    # of each function, collected in one pass
+    if funcs:
+        traces.parse_trace_list(args.p, get_inputs_by_time(
+            args.work_dir, threads=args.meta_threads, sample=args.sample))
+        traces.merge_traces()
+        callers = traces.collect_callers_batch(funcs, levels=args.l)
+        for func, addrs in callers.items():
+            print("%s: %d callers" % (func, len(addrs)))
+            for addr in sorted(addrs):
+                traces.print_addr(addr)
+        return
 
     smatch_map = parse_smatch_file(smatch_file)
 
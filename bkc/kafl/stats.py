@@ -4,17 +4,25 @@
 
 import os
 import sys
+import csv
+import json
+import time
 
 import msgpack
 import argparse
 import subprocess
 
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 from datetime import timedelta
 
 import humanize
 
+import stats_plot
+from node_index import NodeIndex, open_node_index
+
 
 def msgpack_read(pathname):
     with open(pathname, 'rb') as f:
@@ -70,6 +78,14 @@ def print_stats(args, stats):
         print(f"  {i:>10}: {stats['findings'][i]:4d} (last: {last_find[i]})")
 
 
+QUEUE_STAGES = {
+    'initial': 'init',
+    'redq/grim': 'rq/gr',
+    'deterministic': 'deter',
+    'havoc': 'havoc',
+    'final': 'final'}
+
+
 def print_html(args, stats, plotfile):
     last_find = pprint_last_findings(stats)
     done_total = estimate_done(stats)
@@ -100,20 +116,13 @@ def print_html(args, stats, plotfile):
                 "  timeout:   %4d (last: %s)\n" % (stats['findings']['timeout'], last_find['timeout']),
             ])
 
-            queue_stages = {
-                'initial': 'init',
-                'redq/grim': 'rq/gr',
-                'deterministic': 'deter',
-                'havoc': 'havoc',
-                'final': 'final'}
-
             f.writelines([
                 "\nQueue Progress\n",
                 "  %5s  %4s    %4s\n" % ("Stage", "Favs", "Norm"),
             ])
 
-            for stage in queue_stages:
-                f.write("  %5s: %4d  / %4d\n" % (queue_stages[stage],
+            for stage in QUEUE_STAGES:
+                f.write("  %5s: %4d  / %4d\n" % (QUEUE_STAGES[stage],
                                                  stats['aggregate']['fav_states'].get(stage, 0),
                                                  stats['aggregate']['norm_states'].get(stage, 0)))
 
@@ -135,6 +144,203 @@ def print_html(args, stats, plotfile):
         # print("</pre></details></td></tr>")
 
 
+YIELD_METHODS = {
+    'import': "seed/import",
+    'kickstart': "kickstart",
+    'calibrate': "calibrate",
+    'trim': "trim",
+    'trim_center': "trim_center",
+    'stream_color': "stream_color",
+    'stream_zero': "stream_zero",
+    'redq_color': "redq_color",
+    'redq_mutate': "redq_mutate",
+    'redq_dict': "redq_dict",
+    'grim_infer': "grim_infer",
+    'grim_havoc': "grim_havoc",
+    'afl_arith_1': "afl_arith",
+    'afl_arith_2': "afl_arith",
+    'afl_arith_4': "afl_arith",
+    'afl_flip_1/1': "afl_flip",
+    'afl_flip_2/1': "afl_flip",
+    'afl_flip_8/1': "afl_flip",
+    'afl_flip_8/2': "afl_flip",
+    'afl_flip_8/4': "afl_flip",
+    'afl_int_1': "afl_int",
+    'afl_int_2': "afl_int",
+    'afl_int_4': "afl_int",
+    'afl_havoc': "afl_havoc",
+    'afl_splice': "afl_splice",
+    'radamsa': "radamsa",
+    'trim_funky': "funky",
+    'stream_funky': "funky",
+    'validate_bits': "funky",
+    'fixme': "funky",
+    'redq_trace': "funky",
+}
+
+
+def node_queue_state(node):
+    """
+    Return ("fav_states"|"norm_states", state) of a regular node, or None
+    """
+    if node['exit_reason'] != "regular":
+        return None
+    if node['fav_bits'] > 0:
+        return "fav_states", node['state']
+    return "norm_states", node['state']
+
+
+def aggregate_yield(stats):
+    ret = dict()
+    for method, num in stats['yield'].items():
+        ret[YIELD_METHODS[method]] = num
+    return ret
+
+
+def summary_record(stats):
+    """
+    Return the aggregated stats of a workdir as a JSON-serializable dict
+    """
+    total_execs = stats['total_execs']
+    stop_time = stats['start_time'] + stats['runtime']
+    last_found = dict()
+    for exit, last_time in stats['aggregate']['last_found'].items():
+        last_found[exit] = None if last_time == 0 else int(stop_time - last_time)
+
+    record = {
+        'name': stats['name'],
+        'path': str(stats['path']),
+        'runtime': stats['runtime'],
+        'total_execs': total_execs,
+        'execs': stats['execs'],
+        'timeout_rate': stats['num_timeout']/total_execs if total_execs else 0,
+        'funky_rate': stats['num_funky']/total_execs if total_execs else 0,
+        'reload_rate': stats['num_reload']/total_execs if total_execs else 0,
+        'bytes_in_bitmap': stats['bytes_in_bitmap'],
+        'paths_total': stats['paths_total'],
+        'favs_total': stats['favs_total'],
+        'findings': dict(stats['findings']),
+        'last_found': last_found,
+        'fav_states': dict(stats['aggregate']['fav_states']),
+        'norm_states': dict(stats['aggregate']['norm_states']),
+        'yield': dict(stats['aggregate']['yield']),
+        'done': estimate_done(stats),
+    }
+    if 'series' in stats:
+        record['series'] = stats['series']
+    return record
+
+
+def summary_csv_columns():
+    columns = ['name', 'path', 'runtime', 'total_execs', 'execs',
+               'timeout_rate', 'funky_rate', 'reload_rate',
+               'bytes_in_bitmap', 'paths_total', 'favs_total', 'done']
+    for exit in ['regular', 'crash', 'kasan', 'timeout']:
+        columns += [f"findings_{exit}", f"last_found_{exit}"]
+    for stage in QUEUE_STAGES:
+        columns += [f"fav_{stage}", f"norm_{stage}"]
+    for method in sorted(set(YIELD_METHODS.values())):
+        columns.append(f"yield_{method}")
+    return columns
+
+
+def summary_csv_row(record):
+    row = {k: v for k, v in record.items() if not isinstance(v, dict)}
+    for exit in ['regular', 'crash', 'kasan', 'timeout']:
+        row[f"findings_{exit}"] = record['findings'].get(exit, 0)
+        row[f"last_found_{exit}"] = record['last_found'].get(exit)
+    for stage in QUEUE_STAGES:
+        row[f"fav_{stage}"] = record['fav_states'].get(stage, 0)
+        row[f"norm_{stage}"] = record['norm_states'].get(stage, 0)
+    for method, num in record['yield'].items():
+        row[f"yield_{method}"] = num
+    return row
+
+
+class SummaryWriter:
+    """
+    Write one summary record per workdir as soon as it is available, as
+    JSON Lines or CSV. '-' writes to stdout, files are replaced only once
+    complete.
+    """
+
+    def __init__(self, output, fmt):
+        self.output = output
+        self.fmt = fmt
+        if output == '-':
+            self.tmp_file = None
+            self.f = sys.stdout
+        else:
+            self.tmp_file = f"{output}.tmp"
+            self.f = open(self.tmp_file, 'w', newline='')
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(self.f, summary_csv_columns(), restval=0,
+                                      extrasaction='ignore')
+            self.csv.writeheader()
+
+    def write(self, stats):
+        record = summary_record(stats)
+        if self.fmt == 'csv':
+            self.csv.writerow(summary_csv_row(record))
+        else:
+            self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    def close(self):
+        if self.tmp_file:
+            self.f.close()
+            os.replace(self.tmp_file, self.output)
+
+
+def open_summary_writers(args):
+    writers = list()
+    if args.json:
+        writers.append(SummaryWriter(args.json, 'json'))
+    if args.csv:
+        writers.append(SummaryWriter(args.csv, 'csv'))
+    return writers
+
+
+def stats_series(workdir, points, data=None):
+    """
+    Return the main stats.csv time series of a workdir, each downsampled to
+    the given number of points, as {name: [[test cases...], [values...]]}.
+    data may pass in the columns already read by a StatsCsvTail.
+    """
+    columns = {
+        'execs': stats_plot.COL_EXECS,
+        'edges': stats_plot.COL_EDGES,
+        'favs_total': stats_plot.COL_FAVS_TOTAL,
+        'crashes': stats_plot.COL_CRASHES,
+        'kasan': stats_plot.COL_KASAN,
+        'timeouts': stats_plot.COL_TIMEOUTS,
+    }
+    if data is None:
+        data = stats_plot.read_stats_csv(workdir/"stats.csv",
+                                         tuple(columns.values()) + (stats_plot.COL_TEST_CASES,))
+    x = data[stats_plot.COL_TEST_CASES]
+    series = dict()
+    for name, col in columns.items():
+        sx, sy = stats_plot.lttb(x, data[col], points)
+        series[name] = [sx.tolist(), sy.tolist()]
+    return series
+
+
+def print_html_campaign(args, workdirs):
+    """
+    Start the html output with a chart comparing all workdirs
+    """
+    if not stats_plot.have_matplotlib():
+        return
+    plotfile = stats_plot.plot_campaign(workdirs, Path(args.searchdir)/stats_plot.CAMPAIGN_PLOT)
+    with open(args.html, 'a') as f:
+        f.writelines([
+            "<table>\n<tr><th align=left>Campaign</th></tr>\n",
+            f"<tr><td><img width=1000 src=\"{plotfile.relative_to(args.searchdir)}\"></td></tr>\n",
+            "</table>\n\n",
+        ])
+
+
 def stats_aggregate(stats):
 
     ret = {
@@ -144,66 +350,33 @@ def stats_aggregate(stats):
         "yield": {},
     }
 
-    methods = {
-        'import': "seed/import",
-        'kickstart': "kickstart",
-        'calibrate': "calibrate",
-        'trim': "trim",
-        'trim_center': "trim_center",
-        'stream_color': "stream_color",
-        'stream_zero': "stream_zero",
-        'redq_color': "redq_color",
-        'redq_mutate': "redq_mutate",
-        'redq_dict': "redq_dict",
-        'grim_infer': "grim_infer",
-        'grim_havoc': "grim_havoc",
-        'afl_arith_1': "afl_arith",
-        'afl_arith_2': "afl_arith",
-        'afl_arith_4': "afl_arith",
-        'afl_flip_1/1': "afl_flip",
-        'afl_flip_2/1': "afl_flip",
-        'afl_flip_8/1': "afl_flip",
-        'afl_flip_8/2': "afl_flip",
-        'afl_flip_8/4': "afl_flip",
-        'afl_int_1': "afl_int",
-        'afl_int_2': "afl_int",
-        'afl_int_4': "afl_int",
-        'afl_havoc': "afl_havoc",
-        'afl_splice': "afl_splice",
-        'radamsa': "radamsa",
-        'trim_funky': "funky",
-        'stream_funky': "funky",
-        'validate_bits': "funky",
-        'fixme': "funky",
-        'redq_trace': "funky",
-    }
-
     for node in stats['nodes'].values():
-        reason = node['info']['exit_reason']
+        reason = node['exit_reason']
         last_found = ret['last_found'][reason]
-        ret['last_found'][reason] = max(last_found, node['info']['time'])
-
-        if reason == "regular":
-            state = node['state']['name']
-            if len(node['fav_bits']) > 0:
-                fav = "fav_states"
-            else:
-                fav = "norm_states"
+        ret['last_found'][reason] = max(last_found, node['time'])
 
+        queue_state = node_queue_state(node)
+        if queue_state:
+            fav, state = queue_state
             ret[fav][state] = ret[fav].get(state, 0) + 1
 
-    for method, num in stats['yield'].items():
-        ret['yield'][methods[method]] = num
+    ret['yield'] = aggregate_yield(stats)
 
     stats['aggregate'] = ret
 
 
-def generate_plots(workdir):
+def generate_plots(workdir, refresh=False, data=None):
+    if stats_plot.have_matplotlib():
+        return stats_plot.plot_workdir(workdir, refresh=refresh, data=data)
+
+    # fallback to gnuplot, one process per workdir
     GNUPLOT_SCRIPT = Path(os.environ.get("BKC_ROOT"))/"bkc"/"kafl"/"stats.plot"
     STATS_INPUT = workdir/"stats.csv"
     STATS_OUTPUT = workdir/"stats.png"
 
-    if not STATS_OUTPUT.is_file():
+    # with refresh, also redo plots that are older than the input
+    if not STATS_OUTPUT.is_file() or (
+            refresh and STATS_OUTPUT.stat().st_mtime_ns < STATS_INPUT.stat().st_mtime_ns):
         cmd = ["gnuplot",
                "-e", f'set terminal png size 900,800 enhanced; set output "{STATS_OUTPUT}"',
                "-c", f"{GNUPLOT_SCRIPT}",
@@ -230,10 +403,11 @@ def process_workdir(workdir):
             workers[num] = msgpack_read(workers_path)
 
     num_nodes = sum([num for num in stats['findings'].values()])
-    for nid in range(num_nodes):
-        nodes_path = workdir/"metadata/node_{:05d}".format(nid)
-        if nodes_path.is_file():
-            nodes[nid] = msgpack_read(nodes_path)
+    index = open_node_index(str(workdir))
+    for node in index.nodes():
+        if node['id'] < num_nodes:
+            nodes[node['id']] = node
+    index.close()
 
     stats['name'] = workdir.parent.name
     stats['path'] = workdir
@@ -246,27 +420,291 @@ def process_workdir(workdir):
     return stats
 
 
+# per-workdir summary of process_workdir() + stats_aggregate()
+STATS_CACHE_FILE = "stats_cache"
+STATS_CACHE_VERSION = 1
+
+# stats fields that are not needed for the summary output
+STATS_CACHE_SKIP = ('nodes', 'workers', 'path')
+
+
+def workdir_cache_key(workdir):
+    """
+    Summary of a workdir changes with its stats file and the mtime of
+    metadata/, which changes with every node kAFL writes or renames. Returns
+    None if the workdir has no metadata/.
+    """
+    try:
+        meta_mtime_ns = (workdir/"metadata").stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    st = (workdir/"stats").stat()
+    return [st.st_mtime_ns, st.st_size, meta_mtime_ns]
+
+
+def collect_workdir(workdir, use_cache=True, plot=False, series=None):
+    """
+    Return the aggregated stats of a workdir, reusing the stats_cache file
+    in the workdir if its stats and metadata have not changed. With
+    series=<n>, also add the stats.csv series downsampled to n points.
+    Returns None for a workdir without metadata/.
+    """
+    cache_file = workdir/STATS_CACHE_FILE
+    key = workdir_cache_key(workdir)
+    if key is None:
+        print(f"Skipping {workdir}: no metadata/ found", file=sys.stderr)
+        return None
+    stats = None
+
+    if use_cache and cache_file.is_file():
+        try:
+            cache = msgpack_read(cache_file)
+            if cache['version'] == STATS_CACHE_VERSION and cache['key'] == key:
+                stats = cache['stats']
+                stats['path'] = workdir
+        except (ValueError, KeyError, msgpack.UnpackException):
+            stats = None
+
+    if stats is None:
+        stats = process_workdir(workdir)
+        stats_aggregate(stats)
+        if use_cache:
+            summary = {k: v for k, v in stats.items() if k not in STATS_CACHE_SKIP}
+            # replace the cache only once complete, it may be read concurrently
+            tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+            try:
+                with open(tmp_file, 'wb') as f:
+                    f.write(msgpack.packb({'version': STATS_CACHE_VERSION,
+                                           'key': key, 'stats': summary}))
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                print(f"Could not write {cache_file}: {e}", file=sys.stderr)
+                if tmp_file.exists():
+                    tmp_file.unlink()
+
+    # only the summary is passed back to the parent process
+    stats = {k: v for k, v in stats.items() if k not in ('nodes', 'workers')}
+    if series:
+        stats['series'] = stats_series(workdir, series)
+
+    plotfile = generate_plots(workdir) if plot else None
+    return stats, plotfile
+
+
+class WorkdirWatcher:
+    """
+    Keep the result of process_workdir() and stats_aggregate() for a workdir
+    that is still being fuzzed, and update it only from the stats and
+    worker_stats_* files changed since the last poll, the nodes added since
+    then and the lines appended to stats.csv, so polls do not depend on the
+    corpus size. Nodes that kAFL rewrites in place, e.g. to update their
+    queue state, keep the state they had when they were first indexed.
+    """
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.index = NodeIndex(str(workdir))
+        self.csv = stats_plot.StatsCsvTail(workdir/"stats.csv")
+        self.loaded = False
+        self.mtimes = dict()
+        self.stats = None
+        self.workers = dict()
+        self.nodes = dict()
+        self.queue_states = {"fav_states": {}, "norm_states": {}}
+        self.last_found = {"regular": 0, "crash": 0, "kasan": 0, "timeout": 0}
+
+    def changed(self, path):
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if self.mtimes.get(path) == mtime_ns:
+            return False
+        self.mtimes[path] = mtime_ns
+        return True
+
+    def count_node(self, node, num):
+        queue_state = node_queue_state(node)
+        if queue_state:
+            fav, state = queue_state
+            self.queue_states[fav][state] = self.queue_states[fav].get(state, 0) + num
+
+    def poll(self):
+        """
+        Return the updated stats, or None if the fuzzer has not written any
+        stats yet
+        """
+        stats_path = self.workdir/"stats"
+        if self.changed(stats_path):
+            self.stats = msgpack_read(stats_path)
+        if not self.stats:
+            return None
+
+        for num in range(self.stats['num_workers']):
+            workers_path = self.workdir/f"worker_stats_{num}"
+            if self.changed(workers_path):
+                self.workers[num] = msgpack_read(workers_path)
+        if not self.workers or not (self.workdir/"metadata").is_dir():
+            return None
+
+        self.index.update(quick=True)
+        for nid in self.index.removed:
+            node = self.nodes.pop(nid, None)
+            if node:
+                self.count_node(node, -1)
+        # start from all nodes already in the index, then only the changes
+        if self.loaded:
+            changed = self.index.changed
+        else:
+            changed = self.index.nodes()
+            self.loaded = True
+        for node in changed:
+            self.add_node(node)
+
+        return self.summary()
+
+    def add_node(self, node):
+        old_node = self.nodes.get(node['id'])
+        if old_node:
+            self.count_node(old_node, -1)
+        self.nodes[node['id']] = node
+        self.count_node(node, 1)
+        reason = node['exit_reason']
+        self.last_found[reason] = max(self.last_found[reason], node['time'])
+
+    def summary(self):
+        stats = dict(self.stats)
+        num_nodes = sum([num for num in stats['findings'].values()])
+
+        stats['name'] = self.workdir.parent.name
+        stats['path'] = self.workdir
+        stats['runtime'] = max([worker['run_time'] for worker in self.workers.values()])
+        stats['workers'] = self.workers
+        stats['nodes'] = self.nodes
+        stats['execs'] = int(stats['total_execs']/stats['runtime']) if stats['runtime'] else 0
+        stats['paths_total'] = num_nodes
+        stats['aggregate'] = {
+            "fav_states": dict(self.queue_states["fav_states"]),
+            "norm_states": dict(self.queue_states["norm_states"]),
+            "last_found": dict(self.last_found),
+            "yield": aggregate_yield(stats),
+        }
+        return stats
+
+
+def watch_workdirs(args):
+    """
+    Refresh the text or html output every args.watch seconds, until Ctrl-C
+    """
+    watchers = dict()
+    try:
+        while True:
+            for c in Path(args.searchdir).rglob("stats.csv"):
+                if c.parent not in watchers:
+                    watchers[c.parent] = WorkdirWatcher(c.parent)
+
+            results = list()
+            for workdir in sorted(watchers):
+                stats = watchers[workdir].poll()
+                if stats:
+                    plotfile = None
+                    if args.html:
+                        plotfile = generate_plots(workdir, refresh=True,
+                                                  data=watchers[workdir].csv.read())
+                    results.append((stats, plotfile))
+
+            writers = open_summary_writers(args)
+            for stats, _ in results:
+                if args.series and args.json:
+                    stats['series'] = stats_series(stats['path'], args.series,
+                                                   data=watchers[stats['path']].csv.read())
+                for writer in writers:
+                    writer.write(stats)
+            for writer in writers:
+                writer.close()
+
+            if args.html:
+                # replace the html file only once it is complete
+                html_args = argparse.Namespace(**vars(args))
+                html_args.html = args.html.with_name(args.html.name + ".tmp")
+                html_args.html.unlink(missing_ok=True)
+                try:
+                    print_html_campaign(html_args, [stats['path'] for stats, _ in results])
+                    for stats, plotfile in results:
+                        print_html(html_args, stats, plotfile)
+                    if results:
+                        os.replace(html_args.html, args.html)
+                finally:
+                    html_args.html.unlink(missing_ok=True)
+            elif not writers:
+                if sys.stdout.isatty():
+                    print("\033[H\033[J", end="")
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')}: {len(results)} workdirs")
+                for stats, _ in results:
+                    print_stats(args, stats)
+                sys.stdout.flush()
+
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+
+
+def print_results(args, writers, results):
+    # results arrive in order of the sorted workdirs
+    for result in results:
+        if result is None:
+            continue
+        stats, plotfile = result
+        for writer in writers:
+            writer.write(stats)
+        if args.html:
+            print_html(args, stats, plotfile)
+        elif not writers:
+            print_stats(args, stats)
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="kAFL Workdir Summary")
     parser.add_argument("searchdir", help="folder to scan for kAFL workdirs")
     parser.add_argument("--html", metavar='<file>', type=Path,
                         help="produce more detailed html output")
+    parser.add_argument("-j", "--jobs", metavar='<n>', type=int, default=os.cpu_count(),
+                        help="number of workdirs to process and plot in parallel (default: ncpu)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"ignore and do not update the {STATS_CACHE_FILE} of each workdir")
+    parser.add_argument("--json", metavar='<file>', type=str,
+                        help="write one JSON record per workdir (JSON Lines, '-' for stdout)")
+    parser.add_argument("--csv", metavar='<file>', type=str,
+                        help="write one CSV row per workdir ('-' for stdout)")
+    parser.add_argument("--series", metavar='<n>', type=int,
+                        help="add stats.csv time series, downsampled to <n> points, to --json")
+    parser.add_argument("--watch", metavar='<sec>', type=int,
+                        help="keep running and refresh the output every <sec> seconds")
     args = parser.parse_args()
 
-    candidates = Path(args.searchdir).rglob("stats.csv")
+    if args.watch:
+        watch_workdirs(args)
+        return
+
+    candidates = sorted(c.parent for c in Path(args.searchdir).rglob("stats.csv"))
 
     if args.html and args.html.exists():
         os.truncate(args.html, 0)
+    if args.html:
+        print_html_campaign(args, candidates)
+
+    writers = open_summary_writers(args)
+    collect = partial(collect_workdir, use_cache=not args.no_cache, plot=bool(args.html),
+                      series=args.series if args.json else None)
+    if args.jobs > 1 and len(candidates) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            print_results(args, writers, pool.map(collect, candidates))
+    else:
+        print_results(args, writers, map(collect, candidates))
 
-    for c in sorted(candidates):
-        stats = process_workdir(c.parent)
-        stats_aggregate(stats)
-        if args.html:
-            plotfile = generate_plots(c.parent)
-            print_html(args, stats, plotfile)
-        else:
-            print_stats(args, stats)
+    for writer in writers:
+        writer.close()
 
 
 if __name__ == "__main__":
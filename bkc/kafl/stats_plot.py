@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2022 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Render kAFL stats.csv plots in-process with matplotlib
+#
+# Replacement for running gnuplot with stats.plot on each workdir: the CSV is
+# parsed in chunks, long series are reduced with Largest-Triangle-Three-Buckets
+# (LTTB) before plotting, and all workdirs of a campaign can also be drawn into
+# a single comparison chart. matplotlib is optional, stats.py falls back to
+# gnuplot if it is not installed.
+#
+
+import os
+import sys
+import argparse
+import importlib.util
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# stats.csv columns, as used by stats.plot (0-based)
+COL_EXECS = 1
+COL_FAVS_TOTAL = 4
+COL_CRASHES = 5
+COL_KASAN = 6
+COL_TIMEOUTS = 7
+COL_FAVS_WIP = 10
+COL_TEST_CASES = 11
+COL_EDGES = 12
+
+PLOT_COLUMNS = (COL_EXECS, COL_FAVS_TOTAL, COL_CRASHES, COL_KASAN, COL_TIMEOUTS,
+                COL_FAVS_WIP, COL_TEST_CASES, COL_EDGES)
+
+# bytes of stats.csv read and parsed at once
+CSV_CHUNK_SIZE = 1 << 22
+
+# max. points per plotted series
+PLOT_POINTS = 2000
+
+CAMPAIGN_PLOT = "stats_campaign.png"
+
+
+def load_pyplot():
+    """
+    Import matplotlib on first use, with a non-interactive backend.
+    Returns None if matplotlib is not installed.
+    """
+    try:
+        import matplotlib
+    except ImportError:
+        return None
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def have_matplotlib():
+    return importlib.util.find_spec('matplotlib') is not None
+
+
+def parse_csv_chunk(lines, columns):
+    try:
+        return np.loadtxt(lines, delimiter=';', usecols=columns, ndmin=2)
+    except ValueError:
+        pass
+    # a truncated line, e.g. while kAFL is still writing: skip bad lines
+    rows = list()
+    for line in lines:
+        fields = line.split(';')
+        try:
+            rows.append([float(fields[c]) for c in columns])
+        except (ValueError, IndexError):
+            continue
+    return np.array(rows, dtype=np.float64).reshape(-1, len(columns))
+
+
+class StatsCsvTail:
+    """
+    Columns of a stats.csv that kAFL keeps appending to
+
+    Each read() only parses the complete lines added since the last one, into
+    a buffer that grows by doubling. The file is read again from the start if
+    it got shorter.
+    """
+
+    def __init__(self, csv_file, columns=PLOT_COLUMNS):
+        self.csv_file = csv_file
+        self.columns = columns
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.rows = 0
+        self.buf = np.zeros((0, len(self.columns)))
+
+    def append(self, lines):
+        lines = [line for line in lines if line.strip() and not line.startswith('#')]
+        if not lines:
+            return
+        data = parse_csv_chunk(lines, self.columns)
+        if self.rows + len(data) > len(self.buf):
+            buf = np.zeros((max(2*len(self.buf), self.rows + len(data)), len(self.columns)))
+            buf[:self.rows] = self.buf[:self.rows]
+            self.buf = buf
+        self.buf[self.rows:self.rows + len(data)] = data
+        self.rows += len(data)
+
+    def read(self, eof=False):
+        """
+        Return a dict of column -> array of all complete lines so far. With
+        eof, the file is assumed complete and a last line without newline is
+        parsed as well.
+        """
+        try:
+            size = os.path.getsize(self.csv_file)
+        except OSError:
+            size = 0
+        if size < self.offset:
+            self.reset()
+        if size > self.offset:
+            with open(self.csv_file, 'rb') as f:
+                f.seek(self.offset)
+                tail = b''
+                while True:
+                    chunk = f.read(CSV_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    data = tail + chunk
+                    # an incomplete last line is read again next time
+                    cut = data.rfind(b'\n') + 1
+                    data, tail = data[:cut], data[cut:]
+                    self.offset += len(data)
+                    self.append(data.decode().splitlines())
+                if eof and tail:
+                    self.offset += len(tail)
+                    self.append([tail.decode()])
+        return {c: self.buf[:self.rows, i] for i, c in enumerate(self.columns)}
+
+
+def read_stats_csv(csv_file, columns=PLOT_COLUMNS):
+    """
+    Read the given columns of a kAFL stats.csv, CSV_CHUNK_SIZE bytes at a
+    time. Returns a dict of column -> array.
+    """
+    return StatsCsvTail(csv_file, columns).read(eof=True)
+
+
+def lttb(x, y, threshold=PLOT_POINTS):
+    """
+    Downsample the series (x, y) to threshold points with the
+    Largest-Triangle-Three-Buckets algorithm. Returns (x, y).
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    # first and last point are kept, the rest is split into equal buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # average of the next bucket, or the last point
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+
+        bx = x[start:end]
+        by = y[start:end]
+        area = np.abs((x[a] - avg_x) * (by - y[a]) - (x[a] - bx) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return x[selected], y[selected]
+
+
+def plot_workdir(workdir, refresh=False, data=None):
+    """
+    Render <workdir>/stats.png from <workdir>/stats.csv, laid out like
+    stats.plot. Unless refresh is set, an existing plot is kept. data may
+    pass in the columns already read by a StatsCsvTail.
+    """
+    stats_input = workdir/"stats.csv"
+    stats_output = workdir/"stats.png"
+
+    if stats_output.is_file() and (
+            not refresh or stats_output.stat().st_mtime_ns >= stats_input.stat().st_mtime_ns):
+        return stats_output
+
+    plt = load_pyplot()
+    if data is None:
+        data = read_stats_csv(stats_input)
+    x = data[COL_TEST_CASES]
+
+    fig, axes = plt.subplots(3, 1, figsize=(9, 8), dpi=100, sharex=True)
+
+    ax = axes[0]
+    execs = lttb(x, data[COL_EXECS])
+    ax.fill_between(*execs, color='#0090ff', alpha=0.2)
+    ax.plot(*execs, color='#0090ff', linewidth=2, label='Execs/s')
+    ax2 = ax.twinx()
+    ax2.plot(*lttb(x, data[COL_FAVS_WIP]), color='#808080', linewidth=3, label='Favs WIP')
+    ax2.plot(*lttb(x, data[COL_FAVS_TOTAL]), color='#ff0000', linewidth=2, label='Favs Total')
+    ax2.set_ylabel("Favs")
+    handles, labels = ax.get_legend_handles_labels()
+    handles2, labels2 = ax2.get_legend_handles_labels()
+    ax.legend(handles + handles2, labels + labels2, loc='upper left', bbox_to_anchor=(1.1, 1))
+
+    ax = axes[1]
+    ax.plot(*lttb(x, data[COL_EDGES]), color='#404040', linewidth=3, label='Edges')
+    ax.legend(loc='upper left', bbox_to_anchor=(1.1, 1))
+
+    ax = axes[2]
+    for col, title in ((COL_CRASHES, 'Crashes'), (COL_KASAN, 'kASan'), (COL_TIMEOUTS, 'Timeout')):
+        ax.plot(*lttb(x, data[col]), linewidth=2, label=title)
+    ax.legend(loc='upper left', bbox_to_anchor=(1.1, 1))
+    ax.set_xlabel("Test Cases")
+
+    for ax in axes:
+        ax.grid(color='#d0d0d0', linestyle=':')
+        ax.set_ylim(bottom=-0.1)
+
+    fig.subplots_adjust(left=0.1, right=0.72, top=0.97, bottom=0.07)
+    fig.savefig(stats_output)
+    plt.close(fig)
+    return stats_output
+
+
+def plot_campaign(workdirs, output):
+    """
+    Render a single chart comparing edges and favs of all workdirs
+    """
+    plt = load_pyplot()
+    fig, axes = plt.subplots(2, 1, figsize=(12, 8), dpi=100, sharex=True)
+
+    for workdir in workdirs:
+        data = read_stats_csv(workdir/"stats.csv", (COL_FAVS_TOTAL, COL_TEST_CASES, COL_EDGES))
+        x = data[COL_TEST_CASES]
+        label = workdir.parent.name
+        axes[0].plot(*lttb(x, data[COL_EDGES]), linewidth=1.5, label=label)
+        axes[1].plot(*lttb(x, data[COL_FAVS_TOTAL]), linewidth=1.5, label=label)
+
+    axes[0].set_ylabel("Edges")
+    axes[1].set_ylabel("Favs Total")
+    axes[1].set_xlabel("Test Cases")
+    for ax in axes:
+        ax.grid(color='#d0d0d0', linestyle=':')
+    if workdirs:
+        axes[0].legend(loc='upper left', bbox_to_anchor=(1.02, 1), fontsize='small')
+
+    fig.subplots_adjust(left=0.08, right=0.75, top=0.97, bottom=0.07)
+    fig.savefig(output)
+    plt.close(fig)
+    return output
+
+
+def plot_workdirs(workdirs, jobs=None, refresh=False):
+    """
+    Render the plots of all workdirs in parallel, returns their files
+    """
+    if jobs == 1 or len(workdirs) < 2:
+        return [plot_workdir(workdir, refresh) for workdir in workdirs]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(plot_workdir, workdirs, [refresh] * len(workdirs)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plot kAFL stats.csv files")
+    parser.add_argument("searchdir", help="folder to scan for kAFL workdirs")
+    parser.add_argument("-j", "--jobs", metavar='<n>', type=int, default=os.cpu_count(),
+                        help="number of plots to render in parallel (default: ncpu)")
+    parser.add_argument("--refresh", action="store_true",
+                        help="redo plots that are older than their stats.csv")
+    args = parser.parse_args()
+
+    if not have_matplotlib():
+        sys.exit("Error: matplotlib is not installed.")
+
+    workdirs = sorted(c.parent for c in Path(args.searchdir).rglob("stats.csv"))
+    for plotfile in plot_workdirs(workdirs, args.jobs, args.refresh):
+        print(plotfile)
+    print(plot_campaign(workdirs, Path(args.searchdir)/CAMPAIGN_PLOT))
+
+
+if __name__ == "__main__":
+    main()
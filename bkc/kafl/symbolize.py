@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2022 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Symbolize kernel code addresses based on the vmlinux DWARF info
+#
+# In-process replacement for gen_addr2line.sh + strip_addr2line_absolute_path.sh:
+# addresses are resolved in sorted batches per compile unit, using the CU line
+# table and the ranges of its (inlined) functions. Results are the same source
+# locations and inline chains as reported by `eu-addr2line --pretty-print -afi`,
+# with paths made relative to the kernel source tree.
+#
+# Results can be shared between workdirs in a SymbolCache, keyed by the
+# build-id of the ELF file.
+#
+
+import os
+import sys
+import sqlite3
+import hashlib
+import msgpack
+import argparse
+
+from bisect import bisect_left, bisect_right
+
+from elftools.elf.elffile import ELFFile
+from elftools.elf.sections import SymbolTableSection
+from elftools.dwarf.ranges import BaseAddressEntry
+
+
+# DWARF forms of DW_AT_high_pc that give an offset from DW_AT_low_pc
+HIGH_PC_OFFSET_FORMS = ('DW_FORM_data1', 'DW_FORM_data2', 'DW_FORM_data4',
+                        'DW_FORM_data8', 'DW_FORM_udata', 'DW_FORM_sdata',
+                        'DW_FORM_implicit_const')
+
+
+class Scope:
+    """
+    Subprogram or inlined subroutine covering some address ranges
+    """
+    def __init__(self, name, parent=None, call_file=None, call_line=0, call_column=0):
+        self.name = name
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.call_file = call_file
+        self.call_line = call_line
+        self.call_column = call_column
+
+
+class Symbolizer:
+    """
+    Resolve code addresses to function and file:line:column, including the
+    chain of functions the code was inlined into.
+    """
+
+    def __init__(self, elf_file):
+        self.elf_file = elf_file
+        self.stream = open(elf_file, 'rb')
+        self.elf = ELFFile(self.stream)
+        if not self.elf.has_dwarf_info():
+            raise ValueError("No DWARF info found in %s" % elf_file)
+        self.dwarf = self.elf.get_dwarf_info()
+        self.range_lists = self.dwarf.range_lists()
+        self.read_symbols()
+        self.read_cu_ranges()
+        self.prefix = ''
+        self.prefix = self.source_prefix()
+
+    def close(self):
+        self.stream.close()
+
+    def read_symbols(self):
+        """
+        Collect function symbols as fallback for code without DWARF info
+        """
+        symbols = list()
+        self.symbol_addrs = dict()
+        for section in self.elf.iter_sections():
+            if not isinstance(section, SymbolTableSection):
+                continue
+            for sym in section.iter_symbols():
+                if sym['st_info']['type'] != 'STT_FUNC' or not sym['st_value']:
+                    continue
+                symbols.append((sym['st_value'], sym['st_size'], sym.name))
+                self.symbol_addrs.setdefault(sym.name, sym['st_value'])
+        symbols.sort()
+        self.symbol_starts = [s[0] for s in symbols]
+        self.symbols = symbols
+
+    def symbol_at(self, addr):
+        i = bisect_right(self.symbol_starts, addr) - 1
+        if i >= 0:
+            start, size, name = self.symbols[i]
+            if addr < start + max(size, 1):
+                return name
+        return '??'
+
+    def read_cu_ranges(self):
+        """
+        Collect the address ranges of all CUs, from .debug_aranges if present
+        """
+        ranges = list()
+        aranges = self.dwarf.get_aranges()
+        if aranges and aranges.entries:
+            for entry in aranges.entries:
+                ranges.append((entry.begin_addr, entry.begin_addr + entry.length,
+                               entry.info_offset))
+        else:
+            for cu in self.dwarf.iter_CUs():
+                for lo, hi in self.die_ranges(cu.get_top_DIE()):
+                    ranges.append((lo, hi, cu.cu_offset))
+        ranges.sort()
+        self.cu_starts = [r[0] for r in ranges]
+        self.cu_ranges = ranges
+
+    def cu_offset_at(self, addr):
+        i = bisect_right(self.cu_starts, addr) - 1
+        if i >= 0 and addr < self.cu_ranges[i][1]:
+            return self.cu_ranges[i][2]
+        return None
+
+    def die_ranges(self, die):
+        """
+        Return the list of (lo, hi) address ranges covered by a DIE
+        """
+        attrs = die.attributes
+        if 'DW_AT_low_pc' in attrs and 'DW_AT_high_pc' in attrs:
+            lo = attrs['DW_AT_low_pc'].value
+            hi = attrs['DW_AT_high_pc']
+            if hi.form in HIGH_PC_OFFSET_FORMS:
+                return [(lo, lo + hi.value)]
+            return [(lo, hi.value)]
+
+        if 'DW_AT_ranges' not in attrs or self.range_lists is None:
+            return []
+        top = die.cu.get_top_DIE()
+        base = top.attributes['DW_AT_low_pc'].value if 'DW_AT_low_pc' in top.attributes else 0
+        ranges = list()
+        for entry in self.range_lists.get_range_list_at_offset(attrs['DW_AT_ranges'].value, cu=die.cu):
+            if isinstance(entry, BaseAddressEntry):
+                base = entry.base_address
+            elif entry.is_absolute:
+                ranges.append((entry.begin_offset, entry.end_offset))
+            else:
+                ranges.append((base + entry.begin_offset, base + entry.end_offset))
+        return ranges
+
+    @staticmethod
+    def die_name(die):
+        # follow references to the abstract instance or declaration
+        while True:
+            for attr in ('DW_AT_linkage_name', 'DW_AT_MIPS_linkage_name', 'DW_AT_name'):
+                if attr in die.attributes:
+                    return die.attributes[attr].value.decode('utf-8', 'replace')
+            for attr in ('DW_AT_abstract_origin', 'DW_AT_specification'):
+                if attr in die.attributes:
+                    die = die.get_DIE_from_attribute(attr)
+                    break
+            else:
+                return '??'
+
+    def source_files(self, cu, lineprog):
+        """
+        Return the list of file paths referenced by index in the CU line program
+        """
+        top = cu.get_top_DIE()
+        comp_dir = b''
+        if 'DW_AT_comp_dir' in top.attributes:
+            comp_dir = top.attributes['DW_AT_comp_dir'].value
+        dirs = lineprog['include_directory']
+        version = lineprog['version']
+
+        files = list()
+        if version < 5:
+            # file and directory indices are 1-based, directory 0 is comp_dir
+            files.append(None)
+        for entry in lineprog['file_entry']:
+            if version < 5:
+                directory = comp_dir if entry.dir_index == 0 else dirs[entry.dir_index - 1]
+            else:
+                directory = dirs[entry.dir_index]
+            path = os.path.join(comp_dir, directory, entry.name).decode('utf-8', 'replace')
+            if self.prefix:
+                path = path.replace(self.prefix, '')
+            files.append(path)
+        return files
+
+    @staticmethod
+    def line_table(lineprog):
+        """
+        Return the row addresses and (file, line, column) rows of a line
+        program sorted by address, with None rows at the end of sequences
+        """
+        rows = list()
+        for entry in lineprog.get_entries():
+            state = entry.state
+            if state is None:
+                continue
+            if state.end_sequence:
+                rows.append((state.address, 0, len(rows), None))
+            else:
+                rows.append((state.address, 1, len(rows),
+                             (state.file, state.line, state.column)))
+        # like libdw, ends of sequences sort before rows at the same address,
+        # and the last row at an address wins
+        rows.sort()
+        return [r[0] for r in rows], [r[3] for r in rows]
+
+    def cu_scopes(self, cu, addrs):
+        """
+        Return the (lo, hi, scope) ranges of all functions and inlined
+        functions of the CU that contain any of the sorted addrs
+        """
+        def covers(ranges):
+            return any(bisect_left(addrs, lo) < bisect_left(addrs, hi) for lo, hi in ranges)
+
+        scopes = list()
+        stack = [(die, None) for die in cu.get_top_DIE().iter_children()]
+        stack.reverse()
+        while stack:
+            die, parent = stack.pop()
+            if die.tag == 'DW_TAG_lexical_block':
+                if parent:
+                    stack.extend((child, parent) for child in die.iter_children())
+                continue
+            if die.tag == 'DW_TAG_subprogram' and parent is None:
+                ranges = self.die_ranges(die)
+                if not covers(ranges):
+                    continue
+                scope = Scope(self.die_name(die))
+            elif die.tag == 'DW_TAG_inlined_subroutine' and parent:
+                ranges = self.die_ranges(die)
+                if not covers(ranges):
+                    continue
+                attrs = die.attributes
+                scope = Scope(self.die_name(die), parent,
+                              attrs['DW_AT_call_file'].value if 'DW_AT_call_file' in attrs else None,
+                              attrs['DW_AT_call_line'].value if 'DW_AT_call_line' in attrs else 0,
+                              attrs['DW_AT_call_column'].value if 'DW_AT_call_column' in attrs else 0)
+            else:
+                continue
+            scopes.extend((lo, hi, scope) for lo, hi in ranges)
+            stack.extend((child, scope) for child in die.iter_children())
+
+        scopes.sort(key=lambda s: (s[0], s[2].depth))
+        return scopes
+
+    def symbolize_cu(self, cu, addrs):
+        """
+        Yield (addr, frames) for the sorted addrs of one CU
+        """
+        lineprog = self.dwarf.line_program_for_CU(cu)
+        if lineprog is None:
+            files, line_addrs, line_rows = [], [], []
+        else:
+            files = self.source_files(cu, lineprog)
+            line_addrs, line_rows = self.line_table(lineprog)
+        scopes = self.cu_scopes(cu, addrs)
+
+        # sweep over the sorted addrs, keeping the scope ranges that contain them
+        active = list()
+        next_scope = 0
+        for addr in addrs:
+            while next_scope < len(scopes) and scopes[next_scope][0] <= addr:
+                active.append(scopes[next_scope])
+                next_scope += 1
+            active = [s for s in active if s[1] > addr]
+            scope = max(active, key=lambda s: s[2].depth)[2] if active else None
+
+            i = bisect_right(line_addrs, addr) - 1
+            row = line_rows[i] if i >= 0 else None
+            if row and row[0] < len(files):
+                location = (files[row[0]], row[1], row[2])
+            else:
+                location = (None, 0, 0)
+
+            frames = [(scope.name if scope else self.symbol_at(addr),) + location]
+            while scope and scope.parent:
+                call_file = scope.call_file
+                frames.append((scope.parent.name,
+                               files[call_file] if call_file is not None and call_file < len(files) else None,
+                               scope.call_line, scope.call_column))
+                scope = scope.parent
+            yield addr, frames
+
+    def symbolize(self, addrs):
+        """
+        Yield (addr, frames) for the given addrs in sorted order. frames is a
+        list of (func, file, line, column), starting with the innermost
+        function at the source location of addr, followed by each function
+        it was inlined into at the location of the inlined call.
+        """
+        by_cu = dict()
+        for addr in sorted(set(addrs)):
+            by_cu.setdefault(self.cu_offset_at(addr), list()).append(addr)
+
+        results = dict()
+        for cu_offset, cu_addrs in by_cu.items():
+            if cu_offset is None:
+                for addr in cu_addrs:
+                    results[addr] = [(self.symbol_at(addr), None, 0, 0)]
+            else:
+                cu = self.dwarf.get_CU_at(cu_offset)
+                results.update(self.symbolize_cu(cu, cu_addrs))
+
+        for addr in sorted(results):
+            yield addr, results[addr]
+
+    def source_prefix(self):
+        """
+        Return the absolute path of the kernel source tree, based on the
+        location of start_kernel() in init/main.c
+        """
+        addr = self.symbol_addrs.get('start_kernel')
+        if addr is None:
+            return ''
+        for _, frames in self.symbolize([addr]):
+            path = frames[0][1] or ''
+            if 'init/main.c' in path:
+                return path[:path.rfind('init/main.c')]
+        return ''
+
+
+def elf_build_id(elf_file):
+    """
+    Return the GNU build-id of elf_file, or a hash of its contents
+    """
+    with open(elf_file, 'rb') as f:
+        elf = ELFFile(f)
+        for section in elf.iter_sections():
+            if section['sh_type'] != 'SHT_NOTE':
+                continue
+            for note in section.iter_notes():
+                if note['n_type'] == 'NT_GNU_BUILD_ID':
+                    return note['n_desc']
+
+        f.seek(0)
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+        return "sha256-" + digest.hexdigest()
+
+
+class SymbolCache:
+    """
+    Symbolization results of one ELF build, shared by all workdirs using it
+
+    Frames are stored per address in <cache_dir>/<build_id>.db. SQLite
+    takes care of locking between concurrent smatch jobs.
+    """
+
+    # max. number of host parameters in one SQLite statement
+    BATCH_SIZE = 500
+
+    def __init__(self, cache_dir, build_id):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_file = os.path.join(cache_dir, build_id + ".db")
+        self.db = sqlite3.connect(self.db_file, timeout=600)
+        self.db.execute("CREATE TABLE IF NOT EXISTS frames ("
+                        "addr INTEGER PRIMARY KEY, frames BLOB NOT NULL)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def to_key(addr):
+        # SQLite integers are signed 64 bit
+        return addr - (1 << 64) if addr >= (1 << 63) else addr
+
+    @staticmethod
+    def from_key(key):
+        return key + (1 << 64) if key < 0 else key
+
+    def lookup(self, addrs):
+        """
+        Return a dict of addr -> frames for the cached addrs
+        """
+        results = dict()
+        keys = [self.to_key(addr) for addr in addrs]
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i:i+self.BATCH_SIZE]
+            query = ("SELECT addr, frames FROM frames WHERE addr IN (%s)"
+                     % ",".join("?" * len(batch)))
+            for key, frames in self.db.execute(query, batch):
+                results[self.from_key(key)] = [tuple(f) for f in msgpack.unpackb(frames)]
+        return results
+
+    def store(self, results):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO frames (addr, frames) VALUES (?, ?)",
+                ((self.to_key(addr), msgpack.packb(frames)) for addr, frames in results.items()))
+
+
+def symbolize_cached(elf_file, addrs, cache_dir=None):
+    """
+    Yield (addr, frames) like Symbolizer.symbolize(), but only symbolize
+    the addrs not yet found in the SymbolCache at cache_dir
+    """
+    addrs = sorted(set(addrs))
+    cache = None
+    results = dict()
+    if cache_dir:
+        cache = SymbolCache(cache_dir, elf_build_id(elf_file))
+        results = cache.lookup(addrs)
+        print("Found %d of %d addresses in %s" % (len(results), len(addrs), cache.db_file),
+              file=sys.stderr)
+
+    missing = [addr for addr in addrs if addr not in results]
+    if missing:
+        symbolizer = Symbolizer(elf_file)
+        new_results = dict(symbolizer.symbolize(missing))
+        symbolizer.close()
+        if cache:
+            cache.store(new_results)
+        results.update(new_results)
+    if cache:
+        cache.close()
+
+    for addr in addrs:
+        yield addr, results[addr]
+
+
+def format_location(path, line, column):
+    if path is None:
+        return "??:0"
+    if column:
+        return "%s:%d:%d" % (path, line, column)
+    return "%s:%d" % (path, line)
+
+
+def format_frames(addr, frames):
+    """
+    Format the frames of one address like `eu-addr2line --pretty-print -afi`
+    """
+    func, path, line, column = frames[0]
+    lines = ["0x%016x: %s at %s" % (addr, func, format_location(path, line, column))]
+    for func, path, line, column in frames[1:]:
+        lines.append(" (inlined by) %s at %s" % (func, format_location(path, line, column)))
+    return lines
+
+
+def read_edge_blocks(edges_file):
+    """
+    Return the unique src and dst addresses of edges_uniq.lst
+    """
+    blocks = set()
+    with open(edges_file, 'r') as f:
+        for line in f:
+            fields = line.split(',')
+            if len(fields) < 2:
+                continue
+            blocks.add(int(fields[0], 16))
+            blocks.add(int(fields[1], 16))
+    return blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Symbolize kAFL trace coverage.')
+    parser.add_argument('work_dir', metavar='<work_dir>', type=str,
+                        help='target workdir with traces/edges_uniq.lst and target/vmlinux')
+    parser.add_argument('-e', metavar='<vmlinux>', type=str,
+                        help='ELF file to use (default: <work_dir>/target/vmlinux)')
+    parser.add_argument('-o', metavar='<file>', type=str,
+                        help='output file (default: <work_dir>/traces/addr2line.lst)')
+    parser.add_argument('--symbol-cache', metavar='<dir>', type=str,
+                        default=os.environ.get('SYMBOL_CACHE_DIR'),
+                        help='share results per vmlinux build-id in <dir> (default: $SYMBOL_CACHE_DIR)')
+
+    args = parser.parse_args()
+
+    elf_file = args.e or os.path.join(args.work_dir, "target/vmlinux")
+    edges_file = os.path.join(args.work_dir, "traces/edges_uniq.lst")
+    out_file = args.o or os.path.join(args.work_dir, "traces/addr2line.lst")
+
+    if not os.path.exists(elf_file):
+        sys.exit("Error: Could not find %s." % elf_file)
+    if not os.path.exists(edges_file):
+        sys.exit("Error: Supplied workdir is missing coverage info at %s" % edges_file)
+
+    blocks = read_edge_blocks(edges_file)
+    print("Unique blocks found: %d" % len(blocks))
+
+    with open(out_file, 'w') as f:
+        for addr, frames in symbolize_cached(elf_file, blocks, args.symbol_cache):
+            f.write("\n".join(format_frames(addr, frames)) + "\n")
+
+    print("Generated addr2line table: %s" % out_file)
+
+
+if __name__ == "__main__":
+    main()
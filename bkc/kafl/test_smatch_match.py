@@ -0,0 +1,615 @@
+#
+# Copyright (C) 2022 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Tests for the trace parsers of smatch_match.py
+#
+# Run with: python3 -m pytest bkc/kafl/test_smatch_match.py
+#
+
+import csv
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+
+import lz4.frame
+import msgpack
+import numpy as np
+import pytest
+
+from addr_ranges import AddressRangeIndex, SymbolMap
+from node_index import NodeIndex
+from smatch_match import (EDGE_MASK, EXIT_EDGE, EXIT_IP, Addr2LineIndex, TraceCache, TraceParser,
+                          parse_cached_trace)
+
+BASE = 0xffffffff81000000
+
+
+def write_trace(path, records):
+    """
+    Write records of (src, dst) or (src, dst, num) as a lz4 kAFL trace
+    """
+    lines = [",".join("%x" % v for v in rec) + "\n" for rec in records]
+    with lz4.frame.open(path, 'wb') as f:
+        f.write("".join(lines).encode())
+    return str(path)
+
+
+def random_records(seed, count=500, addrs=40):
+    """
+    Random records over a few addresses, with EXIT_IP splices and some
+    records without a num field
+    """
+    rnd = random.Random(seed)
+    records = list()
+    while len(records) < count:
+        src = BASE + rnd.randrange(addrs) * 0x10
+        dst = BASE + rnd.randrange(addrs) * 0x10
+        if rnd.random() < 0.05:
+            # trace leaves the target and re-enters at dst
+            records.append((src, EXIT_IP, 1))
+            records.append((EXIT_IP, dst, 1))
+        elif rnd.random() < 0.3:
+            records.append((src, dst))
+        else:
+            records.append((src, dst, rnd.randrange(1, 1000)))
+    return records
+
+
+def assert_same_findings(trace_file):
+    expected = TraceParser.parse_splice_trace_file(trace_file)
+    found = TraceParser.parse_splice_trace_file_np(trace_file)
+    assert found.keys() == expected.keys()
+    for key in expected:
+        assert found[key] == expected[key], key
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_splice_parity_random(tmp_path, seed):
+    assert_same_findings(write_trace(tmp_path/"fuzz_00001.lst.lz4", random_records(seed)))
+
+
+def test_splice_parity_exit_ip(tmp_path):
+    records = [
+        (BASE + 0x10, BASE + 0x20, 2),
+        (BASE + 0x20, EXIT_IP, 1),
+        (EXIT_IP, BASE + 0x30, 1),
+        (BASE + 0x30, BASE + 0x10),
+        (BASE + 0x10, BASE + 0x20, 3),
+        (BASE + 0x20, EXIT_IP),
+        (EXIT_IP, BASE + 0x40),
+    ]
+    trace_file = write_trace(tmp_path/"fuzz_00001.lst.lz4", records)
+    assert_same_findings(trace_file)
+
+    findings = TraceParser.parse_splice_trace_file_np(trace_file)
+    fake_ip = ((BASE + 0x20) % 0xffffffff << 32) + 0xffffffff
+    assert findings['edges'][((BASE + 0x10) << 64) | (BASE + 0x20)] == 5
+    assert ((fake_ip << 64) | (BASE + 0x30)) in findings['edges']
+    assert ((fake_ip << 64) | (BASE + 0x40)) in findings['edges']
+    assert not any(e & 0xffffffffffffffff == EXIT_IP for e in findings['edges'])
+
+
+def test_splice_parity_missing_num(tmp_path):
+    records = [(BASE + 0x10 * (i % 3), BASE + 0x10 * ((i + 1) % 3)) for i in range(10)]
+    trace_file = write_trace(tmp_path/"fuzz_00001.lst.lz4", records)
+    assert_same_findings(trace_file)
+    findings = TraceParser.parse_splice_trace_file_np(trace_file)
+    assert sum(findings['edges'].values()) == len(records)
+
+
+def test_splice_large_counts(tmp_path):
+    # sums above 2**53 are not exact in float64
+    num = (1 << 53) + 1
+    records = [(BASE + 0x10, BASE + 0x20, num)] * 3
+    trace_file = write_trace(tmp_path/"fuzz_00001.lst.lz4", records)
+    assert_same_findings(trace_file)
+    findings = TraceParser.parse_splice_trace_file_np(trace_file)
+    assert findings['edges'][((BASE + 0x10) << 64) | (BASE + 0x20)] == 3 * num
+
+
+def test_splice_empty_trace(tmp_path):
+    trace_file = write_trace(tmp_path/"fuzz_00001.lst.lz4", [])
+    assert_same_findings(trace_file)
+    edges, links = TraceParser.splice_arrays(*(np.zeros(0, dtype=np.uint64),) * 3)
+    assert edges.shape == (3, 0) and links.shape == (4, 0)
+
+
+def cached_findings(cache, trace_file, backend):
+    return parse_cached_trace(cache.lookup(trace_file) + (backend,))
+
+
+@pytest.mark.parametrize('backend', ['python', 'numpy'])
+def test_trace_cache_parity(tmp_path, backend):
+    trace_files = [write_trace(tmp_path/("fuzz_%05d.lst.lz4" % i), random_records(i))
+                   for i in range(3)]
+    cache = TraceCache(str(tmp_path))
+    with cache.locked():
+        cache.update(1, trace_files)
+    for trace_file in trace_files:
+        assert cached_findings(cache, trace_file, backend) == \
+            TraceParser.parse_splice_trace_file(trace_file)
+
+
+def test_trace_cache_empty_traces(tmp_path):
+    trace_files = [write_trace(tmp_path/("fuzz_%05d.lst.lz4" % i), []) for i in range(3)]
+    cache = TraceCache(str(tmp_path))
+    with cache.locked():
+        cache.update(1, trace_files)
+    assert cache.length == 0
+    for trace_file in trace_files:
+        assert cached_findings(cache, trace_file, 'python')['edges'] == {}
+        assert cached_findings(cache, trace_file, 'numpy')['edges'] == {}
+
+
+def test_trace_cache_prune_deleted(tmp_path):
+    trace_files = [write_trace(tmp_path/("fuzz_%05d.lst.lz4" % i), random_records(i))
+                   for i in range(4)]
+    cache = TraceCache(str(tmp_path))
+    with cache.locked():
+        cache.update(1, trace_files)
+    os.unlink(trace_files[0])
+    os.unlink(trace_files[1])
+    with cache.locked():
+        cache.update(1, trace_files[2:])
+
+    cache = TraceCache(str(tmp_path))
+    cache.load()
+    assert sorted(cache.traces) == [os.path.basename(t) for t in trace_files[2:]]
+    assert cache.length == sum(3*entry[3] for entry in cache.traces.values())
+    for trace_file in trace_files[2:]:
+        assert cached_findings(cache, trace_file, 'python') == \
+            TraceParser.parse_splice_trace_file(trace_file)
+
+
+def test_callsite_seen_edges_reset_on_rebuild(tmp_path):
+    parser = TraceParser(str(tmp_path), use_cache=False)
+    parser.addr2lifu = {BASE + 0x10 * i: ("f.c:%d" % i, "f") for i in range(8)}
+    edge = TraceParser.pack_edge
+
+    parser.global_back_edges.add_back_edges({edge(BASE + 0x60, BASE + 0x70): {EXIT_EDGE}})
+    assert parser.callsite_trace_edge(edge(BASE + 0x60, BASE + 0x70), levels=4)
+
+    # new links re-intern the edges: ids marked seen above now belong to
+    # other edges, which must still be walked
+    parser.global_back_edges.add_back_edges({
+        edge(BASE + 0x10, BASE + 0x20): {EXIT_EDGE},
+        edge(BASE + 0x20, BASE + 0x30): {edge(BASE + 0x10, BASE + 0x20)},
+    })
+    parser.smatch_lino_map = {"f.c:1": ["f"]}
+    assert parser.callsite_trace_edge(edge(BASE + 0x20, BASE + 0x30), levels=4)
+
+
+def test_collect_callers_symbol_map_only_caller(tmp_path):
+    (tmp_path/"traces").mkdir()
+    (tmp_path/"target").mkdir()
+    (tmp_path/"traces"/"addr2line.lst").write_text("0x%x: f at f.c:1\n" % (BASE + 0x10))
+    (tmp_path/"target"/"System.map").write_text(
+        "%016x T f\n%016x T g\n%016x T h\n" % (BASE, BASE + 0x100, BASE + 0x200))
+    parser = TraceParser(str(tmp_path/"traces"), use_cache=False)
+    parser.parse_addr2line()
+
+    # the caller in g is only known from System.map, not from addr2line data
+    parser.callers = {BASE + 0x10: {BASE + 0x120}}
+    callers = parser.collect_callers_batch(['f'], levels=2)
+    assert callers == {'f': {BASE + 0x120}}
+
+
+def run_coverage(trace_dir, nids, incremental=False):
+    parser = TraceParser(str(trace_dir))
+    if incremental:
+        parser.load_coverage_state()
+    parser.parse_trace_list(1, [("payload_%05d" % nid, nid, nid) for nid in nids])
+    parser.gen_reports()
+    return parser
+
+
+def test_incremental_coverage_out_of_order(tmp_path):
+    full_dir, inc_dir = tmp_path/"full", tmp_path/"inc"
+    for trace_dir in (full_dir, inc_dir):
+        trace_dir.mkdir()
+        for nid in range(6):
+            write_trace(trace_dir/("fuzz_%05d.lst.lz4" % nid), random_records(nid, count=100))
+    full = run_coverage(full_dir, range(6))
+
+    # lower ids show up after higher ones were merged, one trace is
+    # missing from the first run, e.g. left out by --sample
+    run_coverage(inc_dir, [3, 5])
+    run_coverage(inc_dir, [0, 3, 4, 5], incremental=True)
+    inc = run_coverage(inc_dir, range(6), incremental=True)
+
+    assert inc.num_traces == full.num_traces == 6
+    assert inc.unique_edges == full.unique_edges
+    assert inc.unique_bbs == full.unique_bbs
+    assert sorted((inc_dir/"edges_uniq.lst").read_text().splitlines()) == \
+        sorted((full_dir/"edges_uniq.lst").read_text().splitlines())
+    assert len((inc_dir/"coverage.csv").read_text().splitlines()) == 6
+
+
+def test_incremental_coverage_changed_trace(tmp_path):
+    for nid in range(3):
+        write_trace(tmp_path/("fuzz_%05d.lst.lz4" % nid), random_records(nid, count=100))
+    run_coverage(tmp_path, range(3))
+    write_trace(tmp_path/"fuzz_00001.lst.lz4", random_records(10, count=100))
+    inc = run_coverage(tmp_path, range(3), incremental=True)
+
+    full_dir = tmp_path/"full"
+    full_dir.mkdir()
+    for nid in range(3):
+        os.link(tmp_path/("fuzz_%05d.lst.lz4" % nid), full_dir/("fuzz_%05d.lst.lz4" % nid))
+    assert inc.unique_edges == run_coverage(full_dir, range(3)).unique_edges
+
+
+def test_collect_callers_after_merge(tmp_path):
+    trace_dir = tmp_path/"traces"
+    trace_dir.mkdir()
+    (tmp_path/"target").mkdir()
+    (trace_dir/"addr2line.lst").write_text(
+        "0x%x: f at f.c:1\n0x%x: g at g.c:1\n0x%x: h at h.c:1\n"
+        % (BASE + 0x10, BASE + 0x110, BASE + 0x210))
+    (tmp_path/"target"/"System.map").write_text(
+        "%016x T f\n%016x T g\n%016x T h\n" % (BASE, BASE + 0x100, BASE + 0x200))
+    write_trace(trace_dir/"fuzz_00000.lst.lz4", [(BASE + 0x110, BASE + 0x10, 1)])
+    write_trace(trace_dir/"fuzz_00001.lst.lz4", [(BASE + 0x210, BASE + 0x10, 1)])
+    parser = TraceParser(str(trace_dir))
+    parser.parse_addr2line()
+
+    parser.parse_trace_list(1, [("payload_00000", 0, 0)])
+    parser.merge_traces()
+    assert parser.collect_callers_batch(['f'], levels=1) == {'f': {BASE + 0x110}}
+
+    # a caller from a later trace must not be hidden by memoized results
+    parser.parse_trace_list(1, [("payload_00001", 1, 1)])
+    parser.merge_traces()
+    assert parser.collect_callers_batch(['f'], levels=1) == {'f': {BASE + 0x110, BASE + 0x210}}
+
+
+ADDR2LINE_LST = """\
+0x%(a)x: f at drivers/x/f.c:10
+0x%(b)x: f_inner at drivers/x/f.c:20:3
+ (inlined by) f at drivers/x/f.c:11:1
+ (inlined by) f_outer at drivers/x/outer.c:5
+0x%(c)x: ?? at ??:0
+0x%(d)x: g at drivers/x/g.c:?
+ (inlined by) g_outer at drivers/x/outer.c:7
+0x%(e)x: g at drivers/x/g.c:30
+0x%(a)x: f at drivers/x/f.c:12
+""" % {'a': BASE + 0x10, 'b': BASE + 0x20, 'c': BASE + 0x30, 'd': BASE + 0x40, 'e': BASE + 0x50}
+
+
+def legacy_parse_addr2line(addr2line):
+    """
+    The line by line regex parser that Addr2LineIndex replaced
+    """
+    addr2lifu, line2addr, func2addr = dict(), dict(), dict()
+    addr = 0
+    with open(addr2line, 'r') as f:
+        for line in f.read().splitlines():
+            m = re.search(r"0x([\da-f]+): ([\S]+) at ([\S]+):[0-9]+$", line)
+            if m:
+                addr = int(m.group(1), 16)
+                func, lino = m.group(2), m.group(3)
+            else:
+                m = re.search(r" \(inlined by\) ([\S]+) at ([\S]+):[0-9]+$", line)
+                if not m:
+                    continue
+                func, lino = m.group(1), m.group(2)
+            addr2lifu[addr] = (lino, func)
+            line2addr.setdefault(lino, list()).append(addr)
+            func2addr.setdefault(func, set()).add(addr)
+    return addr2lifu, line2addr, func2addr
+
+
+def assert_same_addr2line(parser, addr2line):
+    addr2lifu, line2addr, func2addr = legacy_parse_addr2line(addr2line)
+    assert len(parser.addr2lifu) == len(addr2lifu)
+    for addr, lifu in addr2lifu.items():
+        assert addr in parser.addr2lifu
+        assert parser.addr2lifu[addr] == lifu
+    assert BASE not in parser.addr2lifu
+    assert {k: sorted(v) for k, v in parser.line2addr.items()} == \
+        {k: sorted(v) for k, v in line2addr.items()}
+    assert parser.func2addr == func2addr
+
+
+def test_addr2line_index_parse_and_reload(tmp_path):
+    addr2line = tmp_path/"addr2line.lst"
+    addr2line.write_text(ADDR2LINE_LST)
+
+    parser = TraceParser(str(tmp_path))
+    parser.parse_addr2line()
+    assert_same_addr2line(parser, addr2line)
+    assert (tmp_path/"addr2line.idx").exists()
+
+    # a second run loads the saved index instead of parsing again
+    assert Addr2LineIndex(str(addr2line)).load()
+    parser = TraceParser(str(tmp_path))
+    parser.parse_addr2line()
+    assert_same_addr2line(parser, addr2line)
+
+    # the index is rebuilt once addr2line.lst changes
+    addr2line.write_text(ADDR2LINE_LST + "0x%x: h at drivers/x/h.c:1\n" % (BASE + 0x60))
+    assert not Addr2LineIndex(str(addr2line)).load()
+    parser = TraceParser(str(tmp_path))
+    parser.parse_addr2line()
+    assert_same_addr2line(parser, addr2line)
+    assert parser.addr2lifu[BASE + 0x60] == ("drivers/x/h.c", "h")
+
+
+def merged_parser(trace_dir, nids, **kwargs):
+    parser = TraceParser(str(trace_dir), **kwargs)
+    parser.parse_trace_list(2, [("payload_%05d" % nid, nid, nid) for nid in nids])
+    parser.merge_traces()
+    return parser
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_mmap_transport_parity(tmp_path, use_cache):
+    for nid in range(4):
+        write_trace(tmp_path/("fuzz_%05d.lst.lz4" % nid), random_records(nid))
+    write_trace(tmp_path/"fuzz_00004.lst.lz4", [])
+    pickled = merged_parser(tmp_path, range(5), transport='pickle')
+    mapped = merged_parser(tmp_path, range(5), transport='mmap', use_cache=use_cache)
+
+    assert mapped.num_traces == pickled.num_traces
+    assert mapped.unique_edges == pickled.unique_edges
+    assert mapped.unique_bbs == pickled.unique_bbs
+    assert mapped.callers == pickled.callers
+    for edge in pickled.unique_edges:
+        assert sorted(mapped.get_prior_edges(edge)) == sorted(pickled.get_prior_edges(edge))
+
+
+def write_node(work_dir, nid, exit_reason='regular', state='final', fav_bits=0,
+               payload_dir=None):
+    meta = {'id': nid,
+            'info': {'time': 1000.0 + nid, 'exit_reason': exit_reason, 'parent': 0},
+            'state': {'name': state},
+            'fav_bits': {i: 1 for i in range(fav_bits)},
+            'payload_len': 8}
+    payload_dir = work_dir/"corpus"/(payload_dir or exit_reason)
+    payload_dir.mkdir(parents=True, exist_ok=True)
+    (payload_dir/("payload_%05d" % nid)).write_bytes(b"x" * 8)
+    (work_dir/"metadata").mkdir(exist_ok=True)
+    (work_dir/"metadata"/("node_%05d" % nid)).write_bytes(msgpack.packb(meta))
+
+
+def full_index_nodes(work_dir, db_file):
+    index = NodeIndex(str(work_dir), db_file=str(db_file))
+    index.update()
+    return index.nodes()
+
+
+def test_node_index_update_new(tmp_path):
+    work_dir = tmp_path/"workdir"
+    work_dir.mkdir()
+    for nid in range(3):
+        write_node(work_dir, nid)
+    index = NodeIndex(str(work_dir))
+    assert index.update(quick=True) == 3
+    assert index.nodes() == full_index_nodes(work_dir, tmp_path/"full0.db")
+
+    write_node(work_dir, 3, 'crash', fav_bits=2)
+    # kAFL may file the payload under another exit reason
+    write_node(work_dir, 4, 'timeout', payload_dir='regular')
+    assert index.update(quick=True) == 2
+    assert sorted(node['id'] for node in index.changed) == [3, 4]
+    assert index.nodes() == full_index_nodes(work_dir, tmp_path/"full1.db")
+    assert index.nodes()[4]['payload'] == "corpus/regular/payload_00004"
+
+    # a node still being written stops the scan until it is complete
+    (work_dir/"metadata"/"node_00005").write_bytes(b"\x85")
+    write_node(work_dir, 6)
+    assert index.update(quick=True) == 0
+    write_node(work_dir, 5, 'kasan')
+    assert index.update(quick=True) == 2
+    assert index.nodes() == full_index_nodes(work_dir, tmp_path/"full2.db")
+
+    assert index.update(quick=True) == 0
+
+
+def address_range_index(tmp_path, with_symbols):
+    (tmp_path/"addr2line.lst").write_text(
+        "0x%x: f at f.c:10\n0x%x: f at f.c:11\n"
+        "0x%x: f_inner at inner.c:12\n (inlined by) f at f.c:13\n"
+        "0x%x: g at g.c:20\n" % (BASE + 0x10, BASE + 0x20, BASE + 0x30, BASE + 0x110))
+    (tmp_path/"System.map").write_text(
+        "%016x T f\n%016x t g\n%016x D data\n%016x W h\n%016x T _etext\n"
+        % (BASE, BASE + 0x100, BASE + 0x180, BASE + 0x200, BASE + 0x300))
+    symbols = SymbolMap(str(tmp_path/"System.map")) if with_symbols else None
+    return AddressRangeIndex(Addr2LineIndex(str(tmp_path/"addr2line.lst")).open(), symbols)
+
+
+def test_address_range_edges_with_symbols(tmp_path):
+    index = address_range_index(tmp_path, with_symbols=True)
+    f_range = ('f', None, BASE, BASE + 0x100)
+    h_range = ('h', None, BASE + 0x200, BASE + 0x300)
+
+    assert index.lookup(BASE - 1) is None
+    assert index.lookup(BASE) == f_range
+    assert index.lookup(BASE + 0xf) == f_range
+    assert index.lookup(BASE + 0x10) == ('f', 'f.c', BASE + 0x10, BASE + 0x20)
+    assert index.lookup(BASE + 0x1f) == ('f', 'f.c', BASE + 0x10, BASE + 0x20)
+    assert index.lookup(BASE + 0x20) == ('f', 'f.c', BASE + 0x20, BASE + 0x30)
+    # inlined code is attributed to its outermost function
+    assert index.lookup(BASE + 0x30) == ('f', 'f.c', BASE + 0x30, BASE + 0x100)
+    assert index.lookup(BASE + 0xff) == ('f', 'f.c', BASE + 0x30, BASE + 0x100)
+    # the next symbol starts before its first addr2line entry
+    assert index.lookup(BASE + 0x100) == ('g', None, BASE + 0x100, BASE + 0x200)
+    assert index.lookup(BASE + 0x110) == ('g', 'g.c', BASE + 0x110, BASE + 0x200)
+    # data symbols do not end a function
+    assert index.lookup(BASE + 0x1ff) == ('g', 'g.c', BASE + 0x110, BASE + 0x200)
+    assert index.lookup(BASE + 0x200) == h_range
+    assert index.lookup(BASE + 0x2ff) == h_range
+    assert index.lookup(BASE + 0x300) is None
+    assert index.lookup(-1) is None
+    assert index.lookup(1 << 64) is None
+
+
+def test_address_range_edges_without_symbols(tmp_path):
+    index = address_range_index(tmp_path, with_symbols=False)
+
+    assert index.lookup(BASE + 0xf) is None
+    assert index.lookup(BASE + 0x10) == ('f', 'f.c', BASE + 0x10, BASE + 0x20)
+    assert index.lookup(BASE + 0x1f) == ('f', 'f.c', BASE + 0x10, BASE + 0x20)
+    # the next entry is inlined into the same outer function
+    assert index.lookup(BASE + 0x2f) == ('f', 'f.c', BASE + 0x20, BASE + 0x30)
+    # between entries of different functions, the end of f is unknown
+    assert index.lookup(BASE + 0x31) is None
+    assert index.lookup(BASE + 0x110) == ('g', 'g.c', BASE + 0x110, None)
+    assert index.lookup(BASE + 0x111) is None
+
+
+def build_elf(tmp_path, name, build_id):
+    if not shutil.which('gcc'):
+        pytest.skip("needs gcc")
+    src = tmp_path/"main.c"
+    src.write_text("int main(void)\n{\n\treturn 0;\n}\n")
+    elf_file = tmp_path/name
+    subprocess.run(['gcc', '-g', '-O0', f'-Wl,--build-id=0x{build_id}', str(src),
+                    '-o', str(elf_file)], check=True)
+    return str(elf_file)
+
+
+def test_symbol_cache_by_build_id(tmp_path, monkeypatch):
+    symbolize = pytest.importorskip('symbolize')
+    from elftools.elf.elffile import ELFFile
+
+    elf_a = build_elf(tmp_path, "vmlinux_a", "aabb01")
+    elf_b = build_elf(tmp_path, "vmlinux_b", "aabb02")
+    with open(elf_a, 'rb') as f:
+        addr = ELFFile(f).get_section_by_name('.symtab').get_symbol_by_name('main')[0]['st_value']
+    cache_dir = str(tmp_path/"cache")
+
+    assert symbolize.elf_build_id(elf_a) == "aabb01"
+    frames = list(symbolize.symbolize_cached(elf_a, [addr], cache_dir))
+    assert frames[0][1][0][0] == 'main'
+    assert os.path.exists(os.path.join(cache_dir, "aabb01.db"))
+
+    class NoSymbolizer:
+        def __init__(self, elf_file):
+            raise AssertionError("cache miss for %s" % elf_file)
+
+    monkeypatch.setattr(symbolize, 'Symbolizer', NoSymbolizer)
+
+    # same build in another workdir: served from the cache
+    (tmp_path/"other").mkdir()
+    elf_copy = shutil.copy(elf_a, tmp_path/"other"/"vmlinux")
+    assert list(symbolize.symbolize_cached(elf_copy, [addr], cache_dir)) == frames
+    # another build-id does not use the results of the first
+    with pytest.raises(AssertionError):
+        list(symbolize.symbolize_cached(elf_b, [addr], cache_dir))
+
+
+def write_stats_workdir(work_dir):
+    work_dir.mkdir(parents=True)
+    (work_dir/"stats").write_bytes(msgpack.packb({
+        'num_workers': 1, 'start_time': 1000.0, 'total_execs': 1000,
+        'findings': {'regular': 2, 'crash': 1, 'kasan': 0, 'timeout': 0},
+        'yield': {'trim': 2, 'afl_flip_2/1': 3},
+        'favs_total': 1, 'bytes_in_bitmap': 100,
+        'num_timeout': 10, 'num_funky': 5, 'num_reload': 0}))
+    (work_dir/"worker_stats_0").write_bytes(msgpack.packb({'run_time': 100}))
+    (work_dir/"stats.csv").write_text(
+        "#secs;execs/s;paths;pending;favs;crashes;kasan;timeouts;x;cycles;favs_wip;total;edges\n"
+        + "".join("%d;10;%d;0;1;%d;0;0;0;0;0;%d;%d\n" % (t, t, t // 5, 10 * t, 20 + t)
+                  for t in range(10)))
+    write_node(work_dir, 0, fav_bits=1, state='final')
+    write_node(work_dir, 1, state='havoc')
+    write_node(work_dir, 2, 'crash')
+
+
+def run_stats(monkeypatch, *args):
+    import stats
+    monkeypatch.setattr(sys, 'argv', ['stats.py', *map(str, args)])
+    stats.main()
+
+
+def test_stats_summary_output(tmp_path, monkeypatch):
+    import stats
+    write_stats_workdir(tmp_path/"camp"/"harness"/"workdir")
+    json_file, csv_file = tmp_path/"summary.json", tmp_path/"summary.csv"
+    run_stats(monkeypatch, tmp_path/"camp", '-j', 1, '--json', json_file, '--csv', csv_file,
+              '--series', 4)
+
+    records = [json.loads(line) for line in json_file.read_text().splitlines()]
+    assert len(records) == 1
+    record = records[0]
+    series = record.pop('series')
+    assert record == {
+        'name': 'harness',
+        'path': str(tmp_path/"camp"/"harness"/"workdir"),
+        'runtime': 100,
+        'total_execs': 1000,
+        'execs': 10,
+        'timeout_rate': 0.01,
+        'funky_rate': 0.005,
+        'reload_rate': 0.0,
+        'bytes_in_bitmap': 100,
+        'paths_total': 3,
+        'favs_total': 1,
+        'findings': {'regular': 2, 'crash': 1, 'kasan': 0, 'timeout': 0},
+        'last_found': {'regular': 99, 'crash': 98, 'kasan': None, 'timeout': None},
+        'fav_states': {'final': 1},
+        'norm_states': {'havoc': 1},
+        'yield': {'trim': 2, 'afl_flip': 3},
+        'done': pytest.approx(0.7*100 + 0.2*0 + 0.1*100/3),
+    }
+    assert sorted(series) == ['crashes', 'edges', 'execs', 'favs_total', 'kasan', 'timeouts']
+    assert series['edges'] == [[0, 10, 50, 90], [20, 21, 25, 29]]
+    assert series['crashes'] == [[0, 40, 50, 90], [0, 0, 1, 1]]
+
+    with open(csv_file, newline='') as f:
+        reader = csv.DictReader(f)
+        assert reader.fieldnames == stats.summary_csv_columns()
+        rows = list(reader)
+    assert len(rows) == 1
+    assert rows[0]['name'] == 'harness'
+    assert rows[0]['paths_total'] == '3'
+    assert rows[0]['findings_crash'] == '1'
+    assert rows[0]['last_found_regular'] == '99'
+    assert rows[0]['last_found_kasan'] == ''
+    assert rows[0]['fav_final'] == '1'
+    assert rows[0]['norm_havoc'] == '1'
+    assert rows[0]['norm_final'] == '0'
+    assert rows[0]['yield_afl_flip'] == '3'
+
+    # a second run answers from the stats_cache with the same output
+    assert (tmp_path/"camp"/"harness"/"workdir"/stats.STATS_CACHE_FILE).exists()
+    first_json, first_csv = json_file.read_text(), csv_file.read_text()
+    run_stats(monkeypatch, tmp_path/"camp", '-j', 1, '--json', json_file, '--csv', csv_file,
+              '--series', 4)
+    assert json_file.read_text() == first_json
+    assert csv_file.read_text() == first_csv
+
+
+def test_packed_edge_keys():
+    for src, dst in [(0, 0), (0, EDGE_MASK), (EDGE_MASK, 0), (BASE + 0x10, BASE + 0x20),
+                     (EXIT_IP, EXIT_IP)]:
+        edge = TraceParser.pack_edge(src, dst)
+        assert TraceParser.unpack_edge(edge) == [src, dst]
+        assert TraceParser.edge_to_str(edge) == "%016x,%016x" % (src, dst)
+    assert TraceParser.pack_edge(EXIT_IP, EXIT_IP) == EXIT_EDGE
+
+
+@pytest.mark.parametrize('backend', ['python', 'numpy'])
+def test_edges_uniq_matches_string_keys(tmp_path, backend):
+    # edges_uniq.lst as written when edges were keyed by "%016x,%016x" strings
+    legacy = dict()
+    for nid in range(3):
+        records = [r for r in random_records(nid, count=200) if EXIT_IP not in r[:2]]
+        write_trace(tmp_path/("fuzz_%05d.lst.lz4" % nid), records)
+        for rec in records:
+            key = "%016x,%016x" % rec[:2]
+            legacy[key] = legacy.get(key, 0) + (rec[2] if len(rec) > 2 else 1)
+
+    parser = TraceParser(str(tmp_path), backend=backend)
+    parser.parse_trace_list(1, [("payload_%05d" % nid, nid, nid) for nid in range(3)])
+    parser.gen_reports()
+    lines = (tmp_path/"edges_uniq.lst").read_text().splitlines()
+    assert lines == ["%s,%x" % (key, num) for key, num in legacy.items()]